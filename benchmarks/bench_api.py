@@ -0,0 +1,274 @@
+"""
+Load test the API through the real Site and CoreResource, against a database
+filled by generate.py, with Twitter replaced by stub_oauth.py.
+
+    DATABASE_URL=postgresql://localhost/taptap_bench \\
+        python benchmarks/bench_api.py [--concurrency 20] [--requests 500]
+
+Each scenario runs in turn, with --concurrency clients making requests one
+after the other until --requests are done.  The results are printed as JSON:
+latency percentiles in milliseconds, requests per second, response codes, and
+the database queries made per request.  The clients share the reactor with
+the server, so latencies include their overhead too.
+"""
+
+import argparse
+import collections
+import itertools
+import json
+import os
+import random
+import sys
+import threading
+import time
+
+from urllib.parse import urlparse, parse_qs
+
+import treq
+
+from sqlalchemy import event
+
+from treq.client import HTTPClient
+
+from twisted.internet.defer import ensureDeferred, gatherResults
+from twisted.internet.task import react
+from twisted.python.filepath import FilePath
+from twisted.web.client import Agent, HTTPConnectionPool
+from twisted.web.server import Site
+
+import taptap
+from taptap._db import get_engine, cookie_table, user_table, work_table
+
+from stub_oauth import StubOAuth
+
+
+class QueryCounter(object):
+    """
+    Counts the statements sent to the database, from any thread.
+    """
+
+    def __init__(self, engine):
+        self.count = 0
+        self._lock = threading.Lock()
+        event.listen(engine, "before_cursor_execute", self._executed)
+
+    def _executed(self, *args):
+        with self._lock:
+            self.count += 1
+
+
+async def works(http, base, rng, state):
+    work_id, user_id = rng.choice(state["works"])
+    return await request(http, "GET", base + "/api/works/?counts=none&sparkline=60",
+                         user_id)
+
+
+async def work(http, base, rng, state):
+    work_id, user_id = rng.choice(state["works"])
+    return await request(http, "GET",
+                         base + "/api/works/{}?counts=latest".format(work_id),
+                         user_id)
+
+
+async def work_full(http, base, rng, state):
+    work_id, user_id = rng.choice(state["works"])
+    return await request(http, "GET", base + "/api/works/{}".format(work_id),
+                         user_id)
+
+
+async def daily(http, base, rng, state):
+    work_id, user_id = rng.choice(state["works"])
+    return await request(http, "GET",
+                         base + "/api/works/{}/daily".format(work_id), user_id)
+
+
+async def counts(http, base, rng, state):
+    work_id, user_id = rng.choice(state["works"])
+    body = {"count": next(state["counter"]), "target": 50000}
+    return await request(
+        http, "POST", base + "/api/works/{}/counts?counts=latest".format(work_id),
+        user_id, data=json.dumps(body).encode('utf8'))
+
+
+async def login(http, base, rng, state):
+    code, headers = await request(http, "GET", base + "/login/go")
+
+    if code != 302:
+        return code, headers
+
+    location = urlparse(headers.getRawHeaders(b"Location")[0].decode('ascii'))
+    token = parse_qs(location.query)["oauth_token"][0]
+
+    return await request(
+        http, "GET",
+        base + "/login/done?oauth_token={}&oauth_verifier=bench".format(token))
+
+
+SCENARIOS = collections.OrderedDict([
+    ("works", works),
+    ("work", work),
+    ("work_full", work_full),
+    ("daily", daily),
+    ("counts", counts),
+    ("login", login),
+])
+
+
+async def request(http, method, url, user_id=None, **kwargs):
+    cookies = {}
+
+    if user_id is not None:
+        cookies["TAPTAP_TOKEN"] = "bench-{}".format(user_id)
+
+    response = await http.request(method, url, cookies=cookies,
+                                  allow_redirects=False, **kwargs)
+    await treq.content(response)
+    return response.code, response.headers
+
+
+def percentile(ordered, p):
+    if not ordered:
+        return None
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+async def run_scenario(f, http, base, state, queries, concurrency, total,
+                       warmup, seed):
+    rng = random.Random(seed)
+
+    for x in range(warmup):
+        await f(http, base, rng, state)
+
+    latencies = []
+    codes = collections.Counter()
+    remaining = iter(range(total))
+
+    async def client():
+        for x in remaining:
+            started = time.perf_counter()
+            code, headers = await f(http, base, rng, state)
+            latencies.append(time.perf_counter() - started)
+            codes[code] += 1
+
+    queries_before = queries.count
+    started = time.perf_counter()
+    await gatherResults([ensureDeferred(client()) for x in range(concurrency)])
+    elapsed = time.perf_counter() - started
+    queries_made = queries.count - queries_before
+
+    latencies.sort()
+    ms = lambda x: None if x is None else round(x * 1000, 3)
+
+    return collections.OrderedDict([
+        ("requests", total),
+        ("concurrency", concurrency),
+        ("seconds", round(elapsed, 3)),
+        ("throughput", round(total / elapsed, 2)),
+        ("p50_ms", ms(percentile(latencies, 50))),
+        ("p90_ms", ms(percentile(latencies, 90))),
+        ("p99_ms", ms(percentile(latencies, 99))),
+        ("mean_ms", ms(sum(latencies) / len(latencies))),
+        ("max_ms", ms(latencies[-1])),
+        ("status", {str(k): v for k, v in sorted(codes.items())}),
+        ("errors", sum(v for k, v in codes.items() if k >= 400)),
+        ("queries_per_request", round(queries_made / total, 2)),
+    ])
+
+
+async def load_dataset(engine):
+    f = await engine.execute(
+        cookie_table.select().where(cookie_table.c.cookie.like("bench-%")))
+    user_ids = [row[cookie_table.c.id] for row in await f.fetchall()]
+
+    if not user_ids:
+        raise SystemExit("No benchmark users; run benchmarks/generate.py first.")
+
+    f = await engine.execute(
+        user_table.select().where(user_table.c.id.in_(user_ids)))
+    users = {row[user_table.c.id]: row[user_table.c.tzoffset]
+             for row in await f.fetchall()}
+
+    f = await engine.execute(
+        work_table.select().where(work_table.c.user.in_(user_ids)))
+    works = [(row[work_table.c.id], row[work_table.c.user])
+             for row in await f.fetchall()]
+
+    return users, works
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=500,
+                        help="Requests per scenario.")
+    parser.add_argument("--warmup", type=int, default=20)
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--oauth-latency", type=float, default=0.05,
+                        help="Seconds the stub Twitter takes to answer.")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="Write the JSON here, not stdout.")
+    args = parser.parse_args(argv)
+
+    scenarios = args.scenarios.split(",")
+
+    for name in scenarios:
+        if name not in SCENARIOS:
+            parser.error("Unknown scenario {}".format(name))
+
+    async def run(reactor):
+        engine = get_engine()
+        queries = QueryCounter(engine._engine)
+        users, user_works = await load_dataset(engine)
+
+        stub = reactor.listenTCP(
+            0, Site(StubOAuth(reactor, users, args.oauth_latency)),
+            interface="127.0.0.1")
+        os.environ["TWITTER_API_BASE"] = "http://127.0.0.1:{}".format(
+            stub.getHost().port)
+        os.environ.setdefault("TWITTER_KEY", "bench")
+        os.environ.setdefault("TWITTER_SECRET", "bench")
+
+        # Only now, so that it picks up the stub.
+        from taptap.web import CoreResource
+
+        site = Site(CoreResource(FilePath(taptap.__file__).sibling("app").path))
+        site.displayTracebacks = False
+        port = reactor.listenTCP(0, site, interface="127.0.0.1")
+        base = "http://127.0.0.1:{}".format(port.getHost().port)
+
+        pool = HTTPConnectionPool(reactor, persistent=True)
+        pool.maxPersistentPerHost = args.concurrency
+        http = HTTPClient(Agent(reactor, pool=pool))
+
+        state = {
+            "works": user_works,
+            "counter": itertools.count(10 ** 6),
+        }
+
+        results = collections.OrderedDict([
+            ("dataset", {"users": len(users), "works": len(user_works)}),
+            ("scenarios", collections.OrderedDict()),
+        ])
+
+        for name in scenarios:
+            sys.stderr.write("{}...\n".format(name))
+            results["scenarios"][name] = await run_scenario(
+                SCENARIOS[name], http, base, state, queries, args.concurrency,
+                args.requests, args.warmup, args.seed)
+
+        await pool.closeCachedConnections()
+        await port.stopListening()
+        await stub.stopListening()
+
+        output = json.dumps(results, indent=2)
+
+        if args.output:
+            FilePath(args.output).setContent(output.encode('utf8'))
+        else:
+            print(output)
+
+    react(lambda r: ensureDeferred(run(r)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
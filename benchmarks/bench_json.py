@@ -0,0 +1,71 @@
+"""
+Compare the cattr.dumps + json.dumps path with taptap._json.encode for API
+responses holding works with 1 to 100k counts.
+
+    python benchmarks/bench_json.py [--sizes 1,100,10000,100000] [--works 1]
+"""
+
+import argparse
+import cattr
+import json
+import sys
+import time
+
+from taptap._json import encode
+from taptap.web import APIWork
+from taptap.work import CountSeries
+
+
+def legacy_json(item):
+    return json.dumps(cattr.dumps(item), separators=(',',':')).encode('utf8')
+
+
+def make_works(works, size):
+    results = []
+
+    for x in range(works):
+        counts = CountSeries.from_arrays(
+            range(1451606400, 1451606400 + size * 60, 60),
+            range(0, size * 7, 7))
+        results.append(APIWork(id=x, name="Work {}".format(x),
+                               word_target=50000, completed=False,
+                               counts=counts, word_count=counts.latest.count))
+
+    return results
+
+
+def best_of(repeat, f, *args):
+    best = None
+    for x in range(repeat):
+        start = time.perf_counter()
+        result = f(*args)
+        taken = time.perf_counter() - start
+        best = taken if best is None else min(best, taken)
+    return best, result
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="1,100,1000,10000,100000")
+    parser.add_argument("--works", type=int, default=1)
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args(argv)
+
+    print("{:>10} {:>12} {:>12} {:>12} {:>8}".format(
+        "counts", "bytes", "cattr (s)", "encode (s)", "speedup"))
+
+    for size in [int(x) for x in args.sizes.split(",")]:
+        works = make_works(args.works, size)
+
+        legacy_time, legacy = best_of(args.repeat, legacy_json, works)
+        new_time, new = best_of(args.repeat, encode, works)
+
+        if legacy != new:
+            raise SystemExit("Output differs for {} counts".format(size))
+
+        print("{:>10} {:>12} {:>12.6f} {:>12.6f} {:>7.1f}x".format(
+            size, len(new), legacy_time, new_time, legacy_time / new_time))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,159 @@
+"""
+Compare taptap.stats against the per-count loops that works_daily_GET used
+to run, on works with 10k to 1M counts.
+
+    python benchmarks/bench_stats.py [--sizes 10000,100000,1000000]
+"""
+
+import argparse
+import collections
+import datetime
+import math
+import random
+import sys
+import time
+
+from array import array
+
+from taptap.stats import bucket_daily, daily_stats
+
+Count = collections.namedtuple("Count", ["at", "count"])
+
+
+def legacy_daily(counts, word_target, completed, tzoffset, now):
+    counts_by_day = {}
+
+    for count in counts:
+        dt = (datetime.datetime.utcfromtimestamp(count.at) +
+              datetime.timedelta(seconds=tzoffset))
+        t = dt.strftime("%Y-%m-%d")
+        ct = counts_by_day.get(t, [])
+        ct.append(count.count)
+        counts_by_day[t] = ct
+
+    times, values, diffs = [], [], []
+
+    for t, v in counts_by_day.items():
+        mx = max(v)
+        if values:
+            diff = mx - values[-1]
+        else:
+            diff = mx
+        diffs.append(diff)
+        values.append(max(v))
+        times.append(t)
+
+    dates = {}
+
+    for x in range(len(times)):
+        dates[times[x]] = {
+            "diff": diffs[x],
+            "value": values[x]}
+
+    best_day = max(diffs)
+    best_days = [x for x, y in dates.items() if y["diff"] == best_day]
+    until_target = word_target - values[-1]
+
+    start = (datetime.datetime.utcfromtimestamp(counts[0].at) +
+             datetime.timedelta(seconds=tzoffset))
+    if completed:
+        end = (datetime.datetime.utcfromtimestamp(counts[-1].at) +
+               datetime.timedelta(seconds=tzoffset))
+    else:
+        end = now + datetime.timedelta(seconds=tzoffset)
+    days = (end - start).days + 1
+
+    words_per_day = values[-1] // days if values[-1] else 0
+    words_per_writing_day = values[-1] // len(values) if len(values) else 0
+
+    if completed:
+        writing_days_until_target = "N/A"
+        finished_at_pace = "N/A"
+    else:
+        writing_days_until_target = math.ceil(until_target / words_per_writing_day) if until_target != 0 and words_per_writing_day != 0 else "∞"
+        finished_at_pace = ((now - datetime.timedelta(seconds=tzoffset)) + datetime.timedelta(days=math.ceil(until_target / words_per_day))).strftime("%Y-%m-%d") if until_target != 0 and words_per_day != 0 else "∞"
+
+        dat = (now - datetime.timedelta(seconds=tzoffset)).strftime("%Y-%m-%d")
+
+        if dat not in times:
+            times.append(dat)
+            values.append(values[-1])
+            diffs.append(0)
+
+    return {
+        "x": times,
+        "y": values,
+        "stats": {
+            "best_day": "{} ({} words)".format(",".join(best_days), best_day),
+            "until_target": until_target,
+            "words_per_day": words_per_day,
+            "words_per_writing_day": words_per_writing_day,
+            "writing_days_until_target": writing_days_until_target,
+            "finished_at_pace": finished_at_pace
+        }
+    }
+
+
+def array_daily(ats, counts, word_target, completed, tzoffset, now):
+    days, values, firsts, lasts = bucket_daily(ats, counts, tzoffset)
+    return daily_stats(days, values, firsts[0], lasts[-1], word_target,
+                       completed, tzoffset, now=now)
+
+
+def make_counts(n, seed=0):
+    rand = random.Random(seed)
+    at = 1451606400
+    count = 0
+    ats, counts = array('q'), array('q')
+
+    for x in range(n):
+        at += rand.randint(30, 600)
+        count += rand.randint(-20, 80)
+        ats.append(at)
+        counts.append(count)
+
+    return ats, counts
+
+
+def best_of(repeat, f, *args):
+    best = None
+    for x in range(repeat):
+        start = time.perf_counter()
+        result = f(*args)
+        taken = time.perf_counter() - start
+        best = taken if best is None else min(best, taken)
+    return best, result
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sizes", default="10000,100000,1000000")
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args(argv)
+
+    now = datetime.datetime(2017, 6, 1, 12, 0, 0)
+    tzoffset = -18000
+
+    print("{:>10} {:>12} {:>12} {:>8}".format("counts", "legacy (s)", "stats (s)", "speedup"))
+
+    for size in [int(x) for x in args.sizes.split(",")]:
+        ats, counts = make_counts(size)
+        objects = [Count(at=a, count=c) for a, c in zip(ats, counts)]
+
+        for completed in (False, True):
+            legacy_time, legacy = best_of(
+                args.repeat, legacy_daily, objects, 200000, completed,
+                tzoffset, now)
+            new_time, new = best_of(
+                args.repeat, array_daily, ats, counts, 200000, completed,
+                tzoffset, now)
+
+            if legacy != new:
+                raise SystemExit("Results differ for {} counts".format(size))
+
+        print("{:>10} {:>12.4f} {:>12.4f} {:>7.1f}x".format(
+            size, legacy_time, new_time, legacy_time / new_time))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,132 @@
+"""
+Fill an empty database with synthetic users, works and count histories for
+bench_api.py to run against.
+
+    DATABASE_URL=postgresql://localhost/taptap_bench \\
+        python benchmarks/generate.py [--users 100] [--works 5] [--counts 2000]
+
+That makes users * works * counts rows in the counts table, written a batch at
+a time, so millions are fine.  Each user gets a session cookie
+C{bench-<user id>}, and each work its daily rollup.
+"""
+
+import argparse
+import random
+import sys
+import time
+
+from twisted.internet.task import react
+from twisted.internet.defer import ensureDeferred
+
+from taptap._db import (
+    get_engine, user_table, work_table, counts_table, cookie_table
+)
+from taptap.daily import rebuild_daily
+from taptap.migrations import upgrade
+
+TZOFFSETS = [-28800, -18000, 0, 3600, 19800, 36000]
+
+
+def make_counts(rng, work_id, size, start, end):
+    """
+    A history of C{size} counts between C{start} and C{end}, mostly going up
+    with the odd edit taking words out.
+    """
+    step = max(1, (end - start) // max(size, 1))
+    at = start
+    count = 0
+
+    for x in range(size):
+        at += rng.randint(1, 2 * step)
+        count = max(0, count + rng.randint(-100, 500))
+        yield {"work": work_id, "at": at, "count": count}
+
+
+async def insert_batches(engine, table, rows, batch_size):
+    batch = []
+    total = 0
+
+    for row in rows:
+        batch.append(row)
+
+        if len(batch) >= batch_size:
+            await engine.execute(table.insert().values(batch))
+            total += len(batch)
+            batch = []
+
+    if batch:
+        await engine.execute(table.insert().values(batch))
+        total += len(batch)
+
+    return total
+
+
+async def generate(engine, users, works, counts, seed=0, first_user=1,
+                   days=365, batch_size=1000):
+    rng = random.Random(seed)
+    now = int(time.time())
+    user_ids = list(range(first_user, first_user + users))
+    tzoffsets = {x: rng.choice(TZOFFSETS) for x in user_ids}
+
+    await insert_batches(engine, user_table, (
+        {"id": x, "name": "Bench User {}".format(x), "tzoffset": tzoffsets[x]}
+        for x in user_ids), batch_size)
+
+    await insert_batches(engine, cookie_table, (
+        {"cookie": "bench-{}".format(x), "id": x, "expires": now + 86400 * 3650}
+        for x in user_ids), batch_size)
+
+    await insert_batches(engine, work_table, (
+        {"user": x, "name": "Bench Work {}".format(y), "word_target": 50000,
+         "completed": False, "version": 1, "modified": now}
+        for x in user_ids for y in range(works)), batch_size)
+
+    f = await engine.execute(
+        work_table.select().where(work_table.c.user.in_(user_ids)).
+        order_by(work_table.c.id))
+    work_ids = [(row[work_table.c.id], row[work_table.c.user])
+                for row in await f.fetchall()]
+
+    written = 0
+
+    for number, (work_id, user_id) in enumerate(work_ids, 1):
+        start = now - 86400 * rng.randint(1, days)
+        written += await insert_batches(
+            engine, counts_table,
+            make_counts(rng, work_id, counts, start, now), batch_size)
+        await rebuild_daily(work_id, tzoffsets[user_id], engine)
+
+        sys.stderr.write("\rWork {} of {}, {} counts".format(
+            number, len(work_ids), written))
+
+    sys.stderr.write("\n")
+    return {"users": users, "works": len(work_ids), "counts": written}
+
+
+def main(argv):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100)
+    parser.add_argument("--works", type=int, default=5,
+                        help="Works per user.")
+    parser.add_argument("--counts", type=int, default=2000,
+                        help="Counts per work.")
+    parser.add_argument("--days", type=int, default=365,
+                        help="How far back the histories go.")
+    parser.add_argument("--first-user", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    args = parser.parse_args(argv)
+
+    async def run(reactor):
+        engine = get_engine()
+        await upgrade(engine)
+        made = await generate(engine, args.users, args.works, args.counts,
+                              seed=args.seed, first_user=args.first_user,
+                              days=args.days, batch_size=args.batch_size)
+        print(made)
+
+    react(lambda r: ensureDeferred(run(r)))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
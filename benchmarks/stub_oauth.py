@@ -0,0 +1,65 @@
+"""
+A stand-in for the bits of Twitter's API that logging in uses, for
+bench_api.py.  Point taptap at it with TWITTER_API_BASE.
+
+It hands out tokens without checking signatures, and logs in as each of
+C{users} (a dict of user ID to tzoffset) in turn, answering after C{latency}
+seconds to look like a remote server.
+"""
+
+import itertools
+import json
+import re
+
+from urllib.parse import urlencode
+
+from twisted.internet.task import deferLater
+from twisted.web.resource import Resource
+from twisted.web.server import NOT_DONE_YET
+
+_TOKEN = re.compile(r'oauth_token="?([^",]+)')
+
+
+class StubOAuth(Resource):
+    isLeaf = True
+
+    def __init__(self, reactor, users, latency=0.0):
+        super().__init__()
+        self._reactor = reactor
+        self._users = users
+        self._logins = itertools.cycle(sorted(users))
+        self._latency = latency
+        self._tokens = itertools.count()
+        self.calls = 0
+
+    def render(self, request):
+        self.calls += 1
+        d = deferLater(self._reactor, self._latency, self._respond, request)
+        d.addCallback(request.write)
+        d.addCallback(lambda _: request.finish())
+        return NOT_DONE_YET
+
+    def _respond(self, request):
+        path = request.path.decode('ascii')
+
+        if path == "/oauth/request_token":
+            return urlencode({
+                "oauth_token": "request-{}".format(next(self._tokens)),
+                "oauth_token_secret": "secret",
+                "oauth_callback_confirmed": "true"}).encode('ascii')
+
+        if path == "/oauth/access_token":
+            return urlencode({
+                "oauth_token": "access-{}".format(next(self._logins)),
+                "oauth_token_secret": "secret"}).encode('ascii')
+
+        if path == "/1.1/account/verify_credentials.json":
+            auth = request.getHeader("Authorization") or ""
+            token = _TOKEN.search(auth).group(1)
+            user_id = int(token.split("-", 1)[1])
+            request.setHeader("Content-Type", "application/json")
+            return json.dumps({"id": user_id, "name": "Bench User {}".format(user_id),
+                               "utc_offset": self._users[user_id]}).encode('utf8')
+
+        request.setResponseCode(404)
+        return b"Not found"
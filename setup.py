@@ -4,7 +4,26 @@ from __future__ import absolute_import, division, print_function
 
 import os, sys
 
-from setuptools import setup, find_packages, Extension
+from setuptools import setup, find_packages, Extension, Command
+
+
+class build_assets(Command):
+    description = "bundle and fingerprint the frontend's scripts and stylesheets"
+    user_options = []
+
+    def initialize_options(self):
+        pass
+
+    def finalize_options(self):
+        pass
+
+    def run(self):
+        sys.path.insert(0, "src")
+        from taptap.assets import build_bundles
+
+        for name in build_bundles(os.path.join("src", "taptap", "app")):
+            print("wrote", name)
+
 
 if __name__ == "__main__":
 
@@ -33,6 +52,9 @@ if __name__ == "__main__":
         sass_manifests={
             'taptap': ('app/sass', 'app/css', '/css')
         },
+        cmdclass={
+            'build_assets': build_assets,
+        },
         package_dir={"": "src"},
         packages=find_packages('src') + ["twisted.plugins"],
         package_data={
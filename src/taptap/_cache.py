@@ -0,0 +1,62 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """
+    A cache holding at most C{maxsize} entries, dropping the least recently
+    used first, where entries also expire C{ttl} seconds after being set.
+    """
+
+    def __init__(self, maxsize=1024, ttl=300, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._clock = clock
+        self._entries = OrderedDict()
+
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        entry = self._entries.get(key)
+
+        if entry is None:
+            self.misses += 1
+            return default
+
+        value, expires = entry
+
+        if expires < self._clock.seconds():
+            del self._entries[key]
+            self.misses += 1
+            return default
+
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key, value):
+        self._entries[key] = (value, self._clock.seconds() + self.ttl)
+        self._entries.move_to_end(key)
+
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def invalidate(self, key):
+        self._entries.pop(key, None)
+
+    def clear(self):
+        self._entries.clear()
+
+    def stats(self):
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
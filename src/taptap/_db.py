@@ -1,31 +1,122 @@
 import os
+import time
 from alchimia import TWISTED_STRATEGY
 
 from sqlalchemy import create_engine, MetaData
+from sqlalchemy.engine.url import make_url
 from sqlalchemy import (
     Table, Column, Integer, BigInteger, String, ForeignKey, Boolean,
-    UniqueConstraint
+    UniqueConstraint, Index
 )
-from sqlalchemy.schema import CreateTable
 
 from twisted.internet import reactor
+from twisted.internet.defer import ensureDeferred
+
+from .metrics import instrument_engine, observe_trace
+from .tracing import TracingEngine, tracer
 
 metadata = MetaData()
 
 _engine = None
 
 
+def _pool_options(url):
+    """
+    Connection pool settings, from the environment.
+
+    C{TAPTAP_DB_POOL_MIN} connections are kept open once made, and up to
+    C{TAPTAP_DB_POOL_MAX} may be checked out at once.  Connections older than
+    C{TAPTAP_DB_POOL_RECYCLE} seconds are replaced, and every connection is
+    pinged before it is handed out unless C{TAPTAP_DB_POOL_PRE_PING} is 0.
+    """
+    if make_url(url).drivername.startswith("sqlite"):
+        # SQLite uses its own single-connection pools.
+        return {}
+
+    pool_min = int(os.environ.get("TAPTAP_DB_POOL_MIN", 5))
+    pool_max = max(int(os.environ.get("TAPTAP_DB_POOL_MAX", 10)), pool_min)
+
+    return {
+        "pool_size": pool_min,
+        "max_overflow": pool_max - pool_min,
+        "pool_timeout": int(os.environ.get("TAPTAP_DB_POOL_TIMEOUT", 30)),
+        "pool_recycle": int(os.environ.get("TAPTAP_DB_POOL_RECYCLE", 300)),
+        "pool_pre_ping": os.environ.get("TAPTAP_DB_POOL_PRE_PING", "1") != "0",
+    }
+
+
 def get_engine():
 
     global _engine
     if _engine is None:
-        _engine = create_engine(
-            os.environ["DATABASE_URL"], reactor=reactor, strategy=TWISTED_STRATEGY,
+        url = os.environ["DATABASE_URL"]
+        engine = create_engine(
+            url, reactor=reactor, strategy=TWISTED_STRATEGY,
+            **_pool_options(url)
         )
+        instrument_engine(engine._engine)
+        tracer.add_observer(observe_trace)
+        _engine = TracingEngine(engine, tracer)
 
     return _engine
 
 
+class UnitOfWork(object):
+    """
+    An engine-alike that checks out one connection from the pool the first
+    time it is used, and runs every query on it until it is released.
+
+    Code that calls C{connect()} and C{close()} on it gets the shared
+    connection back and leaves it open.
+
+    It counts the statements run on it, and the time spent waiting for them.
+    """
+
+    def __init__(self, engine=None):
+        self._engine = engine or get_engine()
+        self._connection = None
+        self.queries = 0
+        self.query_time = 0.0
+
+    async def connect(self):
+        if self._connection is None:
+            self._connection = await self._engine.connect()
+        return self
+
+    async def execute(self, *args, **kwargs):
+        await self.connect()
+        started = time.perf_counter()
+
+        try:
+            return await self._connection.execute(*args, **kwargs)
+        finally:
+            self.queries += 1
+            self.query_time += time.perf_counter() - started
+
+    async def close(self):
+        pass
+
+    async def release(self):
+        if self._connection is not None:
+            connection, self._connection = self._connection, None
+            await connection.close()
+
+
+def unit_of_work(request):
+    """
+    Get the L{UnitOfWork} for a web request, which is released back to the
+    pool once the response is finished.
+    """
+    uow = getattr(request, "_taptap_unit_of_work", None)
+
+    if uow is None:
+        uow = request._taptap_unit_of_work = UnitOfWork()
+        request.notifyFinish().addBoth(
+            lambda _: ensureDeferred(uow.release()))
+
+    return uow
+
+
 user_table = Table("users", metadata,
                    Column("id", BigInteger(), primary_key=True),
                    Column("name", String()),
@@ -38,14 +129,30 @@ cookie_table = Table("cookies", metadata,
                      Column("expires", Integer(), nullable=False),
 )
 
+# For expire_cookies.
+Index("cookies_expires_idx", cookie_table.c.expires)
+
+# Request tokens of OAuth logins in progress, so that any process can finish
+# a login that another started.
+oauth_token_table = Table("oauth_tokens", metadata,
+                          Column("token", String(), primary_key=True),
+                          Column("secret", String(), nullable=False),
+                          Column("expires", Integer(), nullable=False),
+)
+
 work_table = Table("works", metadata,
                    Column("id", Integer(), primary_key=True),
                    Column("user", BigInteger(), ForeignKey("users.id"), nullable=False),
                    Column("name", String(), nullable=False),
                    Column("word_target", Integer(), nullable=False),
                    Column("completed", Boolean(), nullable=False),
+                   # Bumped on every save, for HTTP caching.
+                   Column("version", Integer(), nullable=False, server_default="0"),
+                   Column("modified", Integer(), nullable=False, server_default="0"),
 )
 
+Index("works_user_idx", work_table.c.user)
+
 counts_table = Table("counts", metadata,
                      Column("work", Integer(), ForeignKey("works.id"), nullable=False),
                      Column("at", Integer(), nullable=False),
@@ -53,35 +160,27 @@ counts_table = Table("counts", metadata,
                      UniqueConstraint("work", "at", "count"),
 )
 
+# The highest count of each work on each local day (days since the epoch,
+# shifted by the owner's tzoffset), kept up to date as counts are saved.
+daily_table = Table("daily_counts", metadata,
+                    Column("work", Integer(), ForeignKey("works.id"), primary_key=True),
+                    Column("day", Integer(), primary_key=True),
+                    Column("tzoffset", Integer(), nullable=False),
+                    Column("value", Integer(), nullable=False),
+                    Column("first_at", Integer(), nullable=False),
+                    Column("last_at", Integer(), nullable=False),
+)
 
 
+# The versions of taptap.migrations that have been applied.
+schema_table = Table("schema_version", metadata,
+                     Column("version", Integer(), primary_key=True),
+                     Column("applied", Integer(), nullable=False),
+)
 
-if __name__ == "__main__":
-
-    from twisted.internet.task import react
-    from twisted.internet.defer import ensureDeferred
-
-    async def main(reactor):
-        engine = get_engine()
-
-        try:
-            await engine.execute(CreateTable(user_table))
-        except:
-            pass
-
-        try:
-            await engine.execute(CreateTable(cookie_table))
-        except:
-            pass
-
-        try:
-            await engine.execute(CreateTable(work_table))
-        except:
-            pass
 
-        try:
-            await engine.execute(CreateTable(counts_table))
-        except:
-            pass
+if __name__ == "__main__":
 
-    react(lambda r: ensureDeferred(main(r)))
+    # The schema is managed by taptap.migrations now.
+    import runpy
+    runpy.run_module("taptap.migrations", run_name="__main__")
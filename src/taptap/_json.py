@@ -0,0 +1,90 @@
+"""
+A JSON encoder for our attrs classes that writes bytes directly, rather than
+going through C{cattr.dumps} and C{json.dumps}.
+
+The output is byte-for-byte the same as
+C{json.dumps(cattr.dumps(item), separators=(',',':')).encode('utf8')}.
+"""
+
+import attr
+
+from json.encoder import encode_basestring_ascii
+
+_encoders = {}
+_attrs_keys = {}
+
+
+def register_encoder(cls, encoder):
+    """
+    Use C{encoder(item, write)} to encode instances of C{cls}.
+    """
+    _encoders[cls] = encoder
+
+
+def _keys_for(cls):
+    keys = _attrs_keys.get(cls)
+
+    if keys is None:
+        keys = _attrs_keys[cls] = [
+            (a.name, encode_basestring_ascii(a.name).encode('ascii') + b':')
+            for a in attr.fields(cls)]
+
+    return keys
+
+
+def _encode_attrs(item, write, fields=None):
+    write(b'{')
+    first = True
+
+    for name, key in _keys_for(item.__class__):
+        if fields is not None and name not in fields:
+            continue
+
+        if not first:
+            write(b',')
+        first = False
+
+        write(key)
+        _encode(getattr(item, name), write)
+
+    write(b'}')
+
+
+def _encode(item, write, fields=None):
+    cls = item.__class__
+
+    if item is None:
+        write(b'null')
+    elif item is True:
+        write(b'true')
+    elif item is False:
+        write(b'false')
+    elif cls is int:
+        write(b'%d' % (item,))
+    elif cls is str:
+        write(encode_basestring_ascii(item).encode('ascii'))
+    elif cls in _encoders:
+        _encoders[cls](item, write)
+    elif attr.has(cls):
+        _encode_attrs(item, write, fields)
+    elif isinstance(item, (list, tuple)):
+        write(b'[')
+        for x, value in enumerate(item):
+            if x:
+                write(b',')
+            _encode(value, write, fields)
+        write(b']')
+    else:
+        raise TypeError("Can't encode {!r}".format(item))
+
+
+def encode(item, fields=None):
+    """
+    Encode an attrs instance, or a list of them, to JSON bytes.
+
+    @param fields: If given, only these attributes of the top-level
+        instances are included.
+    """
+    chunks = []
+    _encode(item, chunks.append, fields)
+    return b''.join(chunks)
@@ -0,0 +1,86 @@
+import os
+import time
+
+from twisted.internet.threads import deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+
+class Offloader(object):
+    """
+    Runs CPU-heavy functions, like statistics and JSON encoding of big works,
+    in a thread pool so that the reactor can carry on serving other requests.
+    Work smaller than C{threshold} is cheaper to just do inline.
+    """
+
+    def __init__(self, reactor=None, minthreads=0, maxthreads=4,
+                 threshold=20000):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self._reactor = reactor
+        self._pool = ThreadPool(minthreads, maxthreads, name="taptap-offload")
+        self.threshold = threshold
+
+        self.pending = 0
+        self.offloaded = 0
+        self.inline = 0
+        self.total_latency = 0.0
+        self.max_latency = 0.0
+
+    def start(self):
+        if not self._pool.started:
+            self._pool.start()
+            self._reactor.addSystemEventTrigger('during', 'shutdown', self.stop)
+
+    def stop(self):
+        if self._pool.started:
+            self._pool.stop()
+
+    async def run(self, size, f, *args, **kwargs):
+        """
+        Call C{f}, in the pool if C{size} (however many counts or days it has
+        to go through) is at least the threshold.
+        """
+        if size < self.threshold:
+            self.inline += 1
+            return f(*args, **kwargs)
+
+        self.start()
+        self.pending += 1
+        started = time.monotonic()
+
+        try:
+            return await deferToThreadPool(self._reactor, self._pool, f,
+                                           *args, **kwargs)
+        finally:
+            latency = time.monotonic() - started
+            self.pending -= 1
+            self.offloaded += 1
+            self.total_latency += latency
+            self.max_latency = max(self.max_latency, latency)
+
+    def stats(self):
+        return {
+            "threads": self._pool.max,
+            "threshold": self.threshold,
+            "pending": self.pending,
+            "offloaded": self.offloaded,
+            "inline": self.inline,
+            "mean_latency": (self.total_latency / self.offloaded
+                             if self.offloaded else 0.0),
+            "max_latency": self.max_latency,
+        }
+
+
+_offloader = None
+
+
+def get_offloader():
+
+    global _offloader
+    if _offloader is None:
+        _offloader = Offloader(
+            maxthreads=int(os.environ.get("TAPTAP_OFFLOAD_THREADS", 4)),
+            threshold=int(os.environ.get("TAPTAP_OFFLOAD_THRESHOLD", 20000)))
+
+    return _offloader
@@ -8,7 +8,7 @@ angular.
             'Work', 'WordCount', 'DailyCounts', '$scope', '$routeParams',
             function WorkDetailController(Work, WordCount, DailyCounts, $scope, $routeParams) {
                 var $this = this
-                $scope.work = Work.get({workID: $routeParams.workID})
+                $scope.work = Work.get({workID: $routeParams.workID, counts: 'latest'})
 
 
                 $this.regraph = function() {
@@ -45,25 +45,69 @@ angular.
 
                 $this.regraph()
 
+                // Move today's point on the graph, rather than redrawing it
+                // from scratch.
+                $this.plotDay = function(day) {
+                    var x = $scope.dailies.x
+                    var y = $scope.dailies.y
+
+                    if (x[x.length - 1] === day[0]) {
+                        y[y.length - 1] = day[1]
+                    } else {
+                        x.push(day[0])
+                        y.push(day[1])
+                    }
+
+                    Plotly.redraw('graph')
+                }
+
+                // Changes from here, other tabs and other devices all arrive
+                // as events, so nothing needs refetching.
+                var events = window.EventSource ?
+                    new EventSource('/api/works/' + $routeParams.workID + '/events') : null
+
+                if (events) {
+                    events.addEventListener('update', function(e) {
+                        var update = JSON.parse(e.data)
+
+                        $scope.$apply(function() {
+                            angular.extend($scope.work, update.work)
+
+                            if ($scope.dailies && update.day) {
+                                $scope.dailies.stats = update.stats
+                                $this.plotDay(update.day)
+                            }
+                        })
+                    })
+
+                    $scope.$on('$destroy', function() {
+                        events.close()
+                    })
+                }
+
                 $scope.update = function() {
                     var input = {"count": $("#wc_number").val(),
                                  "target": $("#wc_target").val()};
-                    WordCount.add({workID: $routeParams.workID}, input).$promise.then(
+                    WordCount.add({workID: $routeParams.workID, counts: 'latest'}, input).$promise.then(
                         function(work) {
                             $scope.work = work;
                             $('#wordcount_modal').modal('hide');
-                            $this.regraph()
+                            if (!events) {
+                                $this.regraph()
+                            }
                         })
                 }
 
                 $scope.update_detail = function() {
                     var input = {"name": $("#detail_name").val(),
                                  "completed": $("#detail_completed").is(":checked")};
-                    Work.update({workID: $routeParams.workID}, input).$promise.then(
+                    Work.update({workID: $routeParams.workID, counts: 'latest'}, input).$promise.then(
                         function(work) {
                             $scope.work = work;
                             $('#detail_modal').modal('hide');
-                            $this.regraph()
+                            if (!events) {
+                                $this.regraph()
+                            }
                         })
                 }
 
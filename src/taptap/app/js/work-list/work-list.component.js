@@ -7,7 +7,7 @@ angular.
         controller: [
             'Works',
             function WorkListController(Works) {
-                this.works = Works.query()
+                this.works = Works.query({counts: 'none', sparkline: 60})
                 this.orderProp = 'name';
 
                 this.is_done = function(work) {
@@ -28,13 +28,13 @@ angular.
                 this.sparkline = function(work) {
                     var done = []
 
-                    for (var i = 0; i < work.counts.length; i++) {
-                        done.push((work.counts[i].at - work.counts[0].at + 1) + ":" + work.counts[i].count)
+                    for (var i = 0; i < work.sparkline.length; i++) {
+                        done.push((work.sparkline[i][0] - work.sparkline[0][0] + 1) + ":" + work.sparkline[i][1])
                     }
 
                     if (work.completed == false) {
                         var d = new Date()
-                        done.push((Math.ceil(d.getTime()/1000) - work.counts[0].at) + ":" + work.word_count)
+                        done.push((Math.ceil(d.getTime()/1000) - work.sparkline[0][0]) + ":" + work.word_count)
                     }
 
                     return done.join(",")
@@ -0,0 +1,107 @@
+"""
+Bundle the frontend's scripts and stylesheets into fingerprinted files.
+
+The blocks of C{<script>}/C{<link>} tags in C{index.html} between
+C{<!-- bundle: NAME.EXT -->} and C{<!-- endbundle -->} are concatenated (and
+minified, if C{rjsmin}/C{rcssmin} are installed) into
+C{dist/NAME.HASH.EXT}, and C{dist/index.html} is written with each block
+replaced by a single tag pointing at its bundle.  As the names change with
+the content, bundles can be cached forever.
+"""
+
+import hashlib
+import os
+import re
+
+try:
+    from rjsmin import jsmin
+except ImportError:
+    jsmin = None
+
+try:
+    from rcssmin import cssmin
+except ImportError:
+    cssmin = None
+
+_BUNDLE = re.compile(
+    r'<!--\s*bundle:\s*(\S+)\s*-->(.*?)<!--\s*endbundle\s*-->', re.DOTALL)
+_SOURCE = re.compile(r'(?:src|href)="([^"]+)"')
+
+FINGERPRINTED = re.compile(r'^[\w-]+\.[0-9a-f]{16}\.(?:js|css)$')
+
+
+def _minify(name, content):
+    if name.endswith(".js") and jsmin is not None:
+        return jsmin(content)
+    if name.endswith(".css") and cssmin is not None:
+        return cssmin(content)
+    return content
+
+
+def _bundle(root, name, sources):
+    parts = []
+
+    for source in sources:
+        with open(os.path.join(root, source), encoding="utf8") as f:
+            parts.append(f.read())
+
+    # A semicolon between scripts stops one file's last statement running
+    # into the next.
+    joiner = "\n;\n" if name.endswith(".js") else "\n"
+    content = _minify(name, joiner.join(parts)).encode("utf8")
+
+    base, ext = os.path.splitext(name)
+    digest = hashlib.sha256(content).hexdigest()[:16]
+    return "{}.{}{}".format(base, digest, ext), content
+
+
+def build_bundles(root, dist="dist"):
+    """
+    Build the bundles listed in C{root}/index.html into C{root}/C{dist}.
+
+    @return: The names of the bundles written.
+    """
+    out = os.path.join(root, dist)
+    os.makedirs(out, exist_ok=True)
+
+    with open(os.path.join(root, "index.html"), encoding="utf8") as f:
+        index = f.read()
+
+    written = []
+
+    def replace(match):
+        name = match.group(1)
+        filename, content = _bundle(root, name, _SOURCE.findall(match.group(2)))
+
+        with open(os.path.join(out, filename), "wb") as f:
+            f.write(content)
+
+        written.append(filename)
+        url = "{}/{}".format(dist, filename)
+
+        if name.endswith(".css"):
+            return '<link rel="stylesheet" href="{}" />'.format(url)
+        return '<script src="{}"></script>'.format(url)
+
+    index = _BUNDLE.sub(replace, index)
+
+    with open(os.path.join(out, "index.html"), "w", encoding="utf8") as f:
+        f.write(index)
+
+    # Old bundles, and their compressed copies, are no longer referenced.
+    for filename in os.listdir(out):
+        bundle = re.sub(r'\.(?:gz|br)$', '', filename)
+
+        if FINGERPRINTED.match(bundle) and bundle not in written:
+            os.remove(os.path.join(out, filename))
+
+    return written
+
+
+if __name__ == "__main__":
+
+    import sys
+
+    for name in build_bundles(sys.argv[1] if len(sys.argv) > 1 else
+                              os.path.join(os.path.dirname(__file__), "app")):
+        print(name)
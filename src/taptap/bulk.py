@@ -0,0 +1,286 @@
+"""
+Bulk export and import of users, works and counts, a batch at a time so that
+memory use stays flat however many counts there are.
+
+    python -m taptap.bulk export ndjson FILE
+    python -m taptap.bulk export csv DIRECTORY
+    python -m taptap.bulk import ndjson FILE
+    python -m taptap.bulk import csv DIRECTORY
+
+NDJSON puts everything in one file (C{-} for stdin/stdout), one record per
+line with a C{"type"} of C{"user"}, C{"work"} or C{"count"}.  CSV writes
+C{users.csv}, C{works.csv} and C{counts.csv} into a directory.  Either way,
+users come before works and works before counts, which is the order they
+have to be imported in.
+"""
+
+import csv
+import io
+import json
+import sys
+
+from sqlalchemy import Boolean, Integer, String, tuple_
+
+from twisted.python.filepath import FilePath
+
+from ._db import get_engine, user_table, work_table, counts_table
+
+TABLES = [user_table, work_table, counts_table]
+
+_KINDS = {
+    user_table: "user",
+    work_table: "work",
+    counts_table: "count",
+}
+
+_TABLES_BY_KIND = {kind: table for table, kind in _KINDS.items()}
+
+# What each table is read in order of, which is also its primary or unique key.
+_KEYS = {
+    user_table: [user_table.c.id],
+    work_table: [work_table.c.id],
+    counts_table: [counts_table.c.work, counts_table.c.at, counts_table.c.count],
+}
+
+
+async def _each_batch(table, engine, batch_size, f):
+    """
+    Call C{f} with every row of C{table} as a dict, in batches of at most
+    C{batch_size}.
+
+    Each batch is its own query, continuing from the key of the last row of
+    the one before, so nothing is held open between them.
+    """
+    keys = _KEYS[table]
+    last = None
+    total = 0
+
+    while True:
+        query = table.select().order_by(*keys).limit(batch_size)
+
+        if last is not None:
+            query = query.where(tuple_(*keys) > tuple_(*last))
+
+        r = await engine.execute(query)
+        rows = await r.fetchall()
+
+        if not rows:
+            break
+
+        f([{x.name: row[x] for x in table.columns} for row in rows])
+        total += len(rows)
+
+        if len(rows) < batch_size:
+            break
+
+        last = [rows[-1][x] for x in keys]
+
+    return total
+
+
+async def export_ndjson(out, engine=None, batch_size=1000):
+    """
+    Write every user, work and count to the binary file C{out}.
+
+    @return: How many rows of each table were written.
+    """
+    if not engine:
+        engine = get_engine()
+
+    written = {}
+
+    for table in TABLES:
+        kind = _KINDS[table]
+
+        def write(records):
+            out.write(b"".join(
+                json.dumps(dict(record, type=kind),
+                           separators=(',', ':')).encode('utf8') + b"\n"
+                for record in records))
+
+        written[table.name] = await _each_batch(table, engine, batch_size,
+                                                write)
+
+    return written
+
+
+async def export_csv(directory, engine=None, batch_size=1000):
+    """
+    Write every user, work and count to CSV files in C{directory}.
+    """
+    if not engine:
+        engine = get_engine()
+
+    directory = FilePath(directory)
+
+    if not directory.exists():
+        directory.makedirs()
+
+    written = {}
+
+    for table in TABLES:
+        path = directory.child(table.name + ".csv").path
+
+        with io.open(path, "w", newline="", encoding="utf8") as f:
+            writer = csv.writer(f)
+            writer.writerow([x.name for x in table.columns])
+
+            def write(records):
+                writer.writerows([[record[x.name] for x in table.columns]
+                                  for record in records])
+
+            written[table.name] = await _each_batch(table, engine, batch_size,
+                                                    write)
+
+    return written
+
+
+class _Loader(object):
+    """
+    Collects rows to import, and inserts them many at a time.
+    """
+
+    def __init__(self, engine, batch_size):
+        self._engine = engine
+        self._batch_size = batch_size
+        self._pending = {table: [] for table in TABLES}
+        self.loaded = {table.name: 0 for table in TABLES}
+
+    async def add(self, table, record):
+        pending = self._pending[table]
+        pending.append(record)
+
+        if len(pending) >= self._batch_size:
+            await self.flush()
+
+    async def flush(self):
+        # Everything goes in at once, parents first, so that a count's work
+        # is always there before it is.
+        for table in TABLES:
+            pending = self._pending[table]
+
+            if pending:
+                await self._engine.execute(table.insert().values(pending))
+                self.loaded[table.name] += len(pending)
+                self._pending[table] = []
+
+
+def _from_csv(table, row):
+    record = {}
+
+    for column in table.columns:
+        value = row[column.name]
+
+        if value == "" and column.nullable and not isinstance(column.type, String):
+            # The csv module writes None as an empty cell.
+            value = None
+        elif isinstance(column.type, Boolean):
+            value = value.lower() in ("1", "true", "t")
+        elif isinstance(column.type, Integer):
+            value = int(value)
+
+        record[column.name] = value
+
+    return record
+
+
+async def _reset_sequences(engine):
+    # Work IDs were inserted as they were, so the sequence handing out new
+    # ones needs to be moved past them.
+    if engine.dialect.name == "postgresql":
+        await engine.execute(
+            "SELECT setval(pg_get_serial_sequence('works', 'id'), "
+            "COALESCE(MAX(id), 0) + 1, false) FROM works")
+
+
+async def import_ndjson(source, engine=None, batch_size=1000):
+    """
+    Read users, works and counts from the binary file C{source}, in the
+    format written by L{export_ndjson}.
+
+    @return: How many rows of each table were imported.
+    """
+    if not engine:
+        engine = get_engine()
+
+    loader = _Loader(engine, batch_size)
+
+    for number, line in enumerate(source, 1):
+        if not line.strip():
+            continue
+
+        record = json.loads(line.decode('utf8'))
+        table = _TABLES_BY_KIND.get(record.pop("type", None))
+
+        if table is None:
+            raise ValueError("Line {} is not a user, work or count".format(
+                number))
+
+        await loader.add(table, {x.name: record[x.name] for x in table.columns
+                                 if x.name in record})
+
+    await loader.flush()
+    await _reset_sequences(engine)
+    return loader.loaded
+
+
+async def import_csv(directory, engine=None, batch_size=1000):
+    """
+    Read users, works and counts from the CSV files written by L{export_csv}.
+    Missing files are skipped.
+    """
+    if not engine:
+        engine = get_engine()
+
+    directory = FilePath(directory)
+    loader = _Loader(engine, batch_size)
+
+    for table in TABLES:
+        path = directory.child(table.name + ".csv")
+
+        if not path.exists():
+            continue
+
+        with io.open(path.path, newline="", encoding="utf8") as f:
+            for row in csv.DictReader(f):
+                await loader.add(table, _from_csv(table, row))
+
+    await loader.flush()
+    await _reset_sequences(engine)
+    return loader.loaded
+
+
+if __name__ == "__main__":
+
+    from twisted.internet.task import react
+    from twisted.internet.defer import ensureDeferred
+
+    async def main(reactor, command=None, fmt=None, path=None):
+
+        if command not in ("export", "import") or fmt not in ("ndjson", "csv") or not path:
+            raise SystemExit(__doc__)
+
+        if command == "export" and fmt == "csv":
+            done = await export_csv(path)
+
+        elif command == "import" and fmt == "csv":
+            done = await import_csv(path)
+
+        elif command == "export":
+            if path == "-":
+                done = await export_ndjson(sys.stdout.buffer)
+            else:
+                with open(path, "wb") as f:
+                    done = await export_ndjson(f)
+
+        else:
+            if path == "-":
+                done = await import_ndjson(sys.stdin.buffer)
+            else:
+                with open(path, "rb") as f:
+                    done = await import_ndjson(f)
+
+        for table in TABLES:
+            sys.stderr.write("{}: {} rows\n".format(table.name, done[table.name]))
+
+    react(lambda r: ensureDeferred(main(r, *sys.argv[1:])))
@@ -0,0 +1,225 @@
+"""
+Compaction of old count history.
+
+Counts newer than the retention window are left alone.  Before it, each
+local day of a work is cut down to its first count, its highest, and its
+last, which are all the daily rollup is made of, so C{/daily} and a work's
+current word count come out the same as before.
+
+    python -m taptap.compaction [--dry-run] [--retention-days 30]
+
+In the server, the first process compacts every C{TAPTAP_COMPACT_INTERVAL}
+seconds if that is set.
+"""
+
+import attr
+import sys
+import time
+
+from sqlalchemy import select, func, and_, or_, not_
+
+from twisted.internet.defer import ensureDeferred
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+
+from ._db import get_engine, counts_table, work_table, user_table
+from .stats import local_day
+from .work import sparkline_cache
+
+# Roughly what a counts row and its index entry take up in PostgreSQL, for
+# when the database can't tell us.
+DEFAULT_ROW_BYTES = 70
+
+
+@attr.s
+class CompactionReport(object):
+    works = attr.ib(default=0)
+    days = attr.ib(default=0)
+    deleted = attr.ib(default=0)
+    bytes_per_row = attr.ib(default=DEFAULT_ROW_BYTES)
+    dry_run = attr.ib(default=False)
+
+    @property
+    def reclaimed(self):
+        """
+        Estimated bytes freed, once the table is vacuumed.
+        """
+        return int(self.deleted * self.bytes_per_row)
+
+
+def keep(ats, values):
+    """
+    Which of one day's counts, in C{(at, count)} order, to keep: the first,
+    the (first) highest, and the last.
+    """
+    highest = max(range(len(values)), key=values.__getitem__)
+    return sorted({0, highest, len(ats) - 1})
+
+
+async def compact_work(work_id, tzoffset, before_day, engine=None,
+                       dry_run=False):
+    """
+    Compact the local days of a work before C{before_day}.
+
+    @return: How many days were compacted and counts deleted.
+    """
+    if not engine:
+        engine = get_engine()
+
+    day = ((counts_table.c.at + tzoffset) / 86400).label("day")
+
+    f = await engine.execute(
+        select([day]).
+        where(counts_table.c.work == work_id).
+        where(counts_table.c.at < before_day * 86400 - tzoffset).
+        group_by(day).
+        having(func.count() > 3))
+    days = [row[0] for row in await f.fetchall()]
+    deleted = 0
+
+    for day in days:
+        start = day * 86400 - tzoffset
+        f = await engine.execute(
+            select([counts_table.c.at, counts_table.c.count]).
+            where(counts_table.c.work == work_id).
+            where(counts_table.c.at >= start).
+            where(counts_table.c.at < start + 86400).
+            order_by(counts_table.c.at, counts_table.c.count))
+        rows = await f.fetchall()
+
+        ats = [row[0] for row in rows]
+        values = [row[1] for row in rows]
+        kept = keep(ats, values)
+        deleted += len(rows) - len(kept)
+
+        if dry_run:
+            continue
+
+        await engine.execute(counts_table.delete().
+                             where(counts_table.c.work == work_id).
+                             where(counts_table.c.at >= start).
+                             where(counts_table.c.at < start + 86400).
+                             where(not_(or_(*[
+                                 and_(counts_table.c.at == ats[x],
+                                      counts_table.c.count == values[x])
+                                 for x in kept]))))
+
+    if deleted and not dry_run:
+        # The full history has changed, so cached copies of it are stale.
+        await engine.execute(work_table.update().
+                             where(work_table.c.id == work_id).
+                             values(version=work_table.c.version + 1,
+                                    modified=int(time.time())))
+        sparkline_cache.invalidate(work_id)
+
+    return len(days), deleted
+
+
+async def _bytes_per_row(engine):
+    if engine.dialect.name != "postgresql":
+        return DEFAULT_ROW_BYTES
+
+    f = await engine.execute(
+        "SELECT pg_total_relation_size('counts')::float / "
+        "GREATEST(reltuples, 1) FROM pg_class WHERE relname = 'counts'")
+    result = await f.scalar()
+    return result or DEFAULT_ROW_BYTES
+
+
+async def compact(engine=None, retention_days=30, dry_run=False, now=None):
+    """
+    Compact every work's counts from more than C{retention_days} ago, or with
+    C{dry_run}, only count what would go.
+
+    @rtype: L{CompactionReport}
+    """
+    if not engine:
+        engine = get_engine()
+
+    if now is None:
+        now = time.time()
+
+    cutoff = int(now) - retention_days * 86400
+    report = CompactionReport(dry_run=dry_run,
+                              bytes_per_row=await _bytes_per_row(engine))
+
+    f = await engine.execute(
+        work_table.join(user_table, work_table.c.user == user_table.c.id).
+        select().with_only_columns([work_table.c.id, user_table.c.tzoffset]).
+        order_by(work_table.c.id))
+
+    for work_id, tzoffset in await f.fetchall():
+        # Only whole local days, so the one the cutoff falls in is kept.
+        days, deleted = await compact_work(
+            work_id, tzoffset, local_day(cutoff, tzoffset), engine, dry_run)
+
+        if deleted:
+            report.works += 1
+            report.days += days
+            report.deleted += deleted
+
+    return report
+
+
+class Compactor(object):
+    """
+    Runs L{compact} every C{interval} seconds.
+    """
+    _log = Logger()
+
+    def __init__(self, interval, retention_days=30, clock=None):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self._interval = interval
+        self._retention_days = retention_days
+        self._loop = LoopingCall(self._compact)
+        self._loop.clock = clock
+
+    def start(self):
+        if not self._loop.running:
+            self._loop.start(self._interval, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def _compact(self):
+        d = ensureDeferred(compact(retention_days=self._retention_days))
+
+        @d.addCallback
+        def _(report):
+            self._log.info(
+                "Compacted {days} days of {works} works, deleting {deleted} "
+                "counts", days=report.days, works=report.works,
+                deleted=report.deleted)
+
+        d.addErrback(lambda f: self._log.failure("Failed to compact counts", f))
+        return d
+
+
+if __name__ == "__main__":
+
+    import argparse
+
+    from twisted.internet.task import react
+
+    parser = argparse.ArgumentParser(prog="python -m taptap.compaction")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="Report what would be deleted, but don't.")
+    parser.add_argument("--retention-days", type=int, default=30,
+                        help="Keep every count from this many days back.")
+    args = parser.parse_args(sys.argv[1:])
+
+    async def main(reactor):
+        report = await compact(retention_days=args.retention_days,
+                               dry_run=args.dry_run)
+
+        print("{} {} counts from {} days of {} works, about {:.1f} MB".format(
+            "Would delete" if report.dry_run else "Deleted", report.deleted,
+            report.days, report.works, report.reclaimed / 1e6))
+
+        if report.deleted and not report.dry_run:
+            print("The space is reused once the counts table is vacuumed.")
+
+    react(lambda r: ensureDeferred(main(r)))
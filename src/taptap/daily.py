@@ -0,0 +1,200 @@
+import attr
+
+from attr.validators import instance_of
+from sqlalchemy import case
+from sqlalchemy.exc import IntegrityError
+
+from ._db import get_engine, daily_table, work_table, user_table
+from .stats import bucket_daily
+
+
+@attr.s
+class DailyCount(object):
+    """
+    The highest count on a local day, and when the first and last counts on
+    that day were made.
+    """
+    day = attr.ib(validator=instance_of(int))
+    value = attr.ib(validator=instance_of(int))
+    first_at = attr.ib(validator=instance_of(int))
+    last_at = attr.ib(validator=instance_of(int))
+
+    @classmethod
+    def _from_data(cls, data):
+        return cls(
+            day=data[daily_table.c.day],
+            value=data[daily_table.c.value],
+            first_at=data[daily_table.c.first_at],
+            last_at=data[daily_table.c.last_at],
+        )
+
+    def _to_values(self, work_id, tzoffset):
+        return {
+            "work": work_id,
+            "day": self.day,
+            "tzoffset": tzoffset,
+            "value": self.value,
+            "first_at": self.first_at,
+            "last_at": self.last_at,
+        }
+
+
+def rollup(counts, tzoffset):
+    """
+    Roll a L{CountSeries} up into L{DailyCount}s, in day order.
+    """
+    days, values, firsts, lasts = bucket_daily(counts.ats, counts.values,
+                                               tzoffset)
+
+    return [DailyCount(day=days[x], value=values[x],
+                       first_at=firsts[x], last_at=lasts[x])
+            for x in range(len(days))]
+
+
+async def rebuild_daily(work_id, tzoffset, engine=None):
+    """
+    Replace the rollup of a work with one made from all of its counts.
+    """
+    from .work import WordCount
+
+    if not engine:
+        engine = get_engine()
+
+    e = await engine.connect()
+
+    try:
+        days = rollup(await WordCount.load_for(work_id, engine=e), tzoffset)
+
+        await e.execute(daily_table.delete().where(daily_table.c.work == work_id))
+
+        if days:
+            await e.execute(daily_table.insert().values(
+                [day._to_values(work_id, tzoffset) for day in days]))
+    finally:
+        await e.close()
+
+    return days
+
+
+def _merge(work_id, day):
+    """
+    An update folding C{day} into the row already there.  It is worked out in
+    the database, so that updates of the same day at once don't undo each
+    other.
+    """
+    c = daily_table.c
+
+    return (daily_table.update().
+            where(c.work == work_id).
+            where(c.day == day.day).
+            values(value=case([(c.value < day.value, day.value)],
+                              else_=c.value),
+                   first_at=case([(c.first_at > day.first_at, day.first_at)],
+                                 else_=c.first_at),
+                   last_at=case([(c.last_at < day.last_at, day.last_at)],
+                                else_=c.last_at)))
+
+
+async def _upsert(e, work_id, day, tzoffset):
+    f = await e.execute(_merge(work_id, day))
+
+    if f.rowcount:
+        return
+
+    try:
+        await e.execute(daily_table.insert().values(
+            day._to_values(work_id, tzoffset)))
+    except IntegrityError:
+        # Something else added the day since we looked.
+        await e.execute(_merge(work_id, day))
+
+
+async def update_daily(work_id, counts, tzoffset, engine=None):
+    """
+    Fold newly saved counts into the rollup of a work.
+    """
+    new_days = rollup(counts, tzoffset)
+
+    if not new_days:
+        return
+
+    if not engine:
+        engine = get_engine()
+
+    e = await engine.connect()
+
+    try:
+        f = await e.execute(
+            daily_table.select().
+            with_only_columns([daily_table.c.day, daily_table.c.tzoffset]).
+            where(daily_table.c.work == work_id).
+            where(daily_table.c.day.in_([x.day for x in new_days])))
+        existing = await f.fetchall()
+
+        # If the user has moved timezone since these were rolled up, the
+        # days no longer line up.
+        moved = any(row[daily_table.c.tzoffset] != tzoffset for row in existing)
+
+        if not moved:
+            existing = {row[daily_table.c.day] for row in existing}
+            inserts = [day for day in new_days if day.day not in existing]
+
+            for day in new_days:
+                if day.day in existing:
+                    await _upsert(e, work_id, day, tzoffset)
+
+            if inserts:
+                try:
+                    await e.execute(daily_table.insert().values(
+                        [day._to_values(work_id, tzoffset) for day in inserts]))
+                except IntegrityError:
+                    for day in inserts:
+                        await _upsert(e, work_id, day, tzoffset)
+    finally:
+        await e.close()
+
+    if moved:
+        await rebuild_daily(work_id, tzoffset, engine)
+
+
+async def load_daily(work_id, tzoffset, engine=None):
+    """
+    Load the rollup of a work, in day order, building it first if it is
+    missing or was made for a different timezone.
+    """
+    if not engine:
+        engine = get_engine()
+
+    e = await engine.connect()
+
+    f = await e.execute(daily_table.select().
+                        where(daily_table.c.work == work_id).
+                        order_by(daily_table.c.day))
+    result = await f.fetchall()
+
+    await e.close()
+
+    if not result or any(row[daily_table.c.tzoffset] != tzoffset
+                         for row in result):
+        return await rebuild_daily(work_id, tzoffset, engine)
+
+    return [DailyCount._from_data(row) for row in result]
+
+
+if __name__ == "__main__":
+
+    from twisted.internet.task import react
+    from twisted.internet.defer import ensureDeferred
+
+    async def main(reactor):
+        engine = get_engine()
+
+        f = await engine.execute(
+            work_table.join(user_table, work_table.c.user == user_table.c.id).
+            select().with_only_columns([work_table.c.id, user_table.c.tzoffset]))
+
+        for work_id, tzoffset in await f.fetchall():
+            days = await rebuild_daily(work_id, tzoffset, engine)
+            print("Work {}: {} days".format(work_id, len(days)))
+
+    react(lambda r: ensureDeferred(main(r)))
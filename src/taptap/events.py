@@ -0,0 +1,203 @@
+"""
+Server-sent events about works, so that every open page showing a work is
+updated when it changes, without refetching its whole daily history.
+
+Each update is an C{update} event carrying the work's details and current
+word count, its newest count, today's point on the daily graph, and the
+daily statistics.
+"""
+
+import datetime
+import json
+
+from twisted.internet.defer import Deferred, ensureDeferred
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+
+from ._db import get_engine, work_table
+from .daily import load_daily
+from .stats import daily_stats
+from .users import User
+
+
+async def work_update(work_id, user_id, engine=None):
+    """
+    The state of a work to send out, and the version it was at.
+    """
+    user = await User.load(user_id, engine=engine)
+    work = await user.load_work(work_id, engine=engine, counts="latest")
+    latest = work.counts.latest
+
+    message = {
+        "work": {
+            "id": work.id,
+            "name": work.name,
+            "word_target": work.word_target,
+            "completed": work.completed,
+            "word_count": latest.count if latest else 0,
+        },
+        "count": {"at": latest.at, "count": latest.count} if latest else None,
+    }
+
+    daily = await load_daily(work.id, user.tzoffset, engine=engine)
+
+    if daily:
+        result = daily_stats(
+            [x.day for x in daily], [x.value for x in daily],
+            daily[0].first_at, daily[-1].last_at,
+            work.word_target, work.completed, user.tzoffset,
+            now=datetime.datetime.now())
+        message["day"] = [result["x"][-1], result["y"][-1]]
+        message["stats"] = result["stats"]
+
+    return work.version, message
+
+
+class _Stream(object):
+    __slots__ = ("work_id", "user_id", "request", "closed")
+
+    def __init__(self, work_id, user_id, request):
+        self.work_id = work_id
+        self.user_id = user_id
+        self.request = request
+        self.closed = Deferred()
+
+
+class EventHub(object):
+    """
+    The event streams open in this process, by work.
+
+    Changes made here are sent as they happen.  Every C{interval} seconds,
+    streams are sent a comment to keep them open, and the versions of the
+    works being watched are checked, so that changes made by other processes
+    are sent too.
+    """
+    _log = Logger()
+
+    def __init__(self, clock=None, interval=5):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self._streams = {}
+        self._versions = {}
+        self._interval = interval
+
+        self._ticker = LoopingCall(self._tick)
+        self._ticker.clock = clock
+
+    def start(self):
+        if not self._ticker.running:
+            self._ticker.start(self._interval, now=False)
+
+    def stop(self):
+        if self._ticker.running:
+            self._ticker.stop()
+
+        for streams in list(self._streams.values()):
+            for stream in list(streams):
+                self.unsubscribe(stream)
+
+    def subscribe(self, work_id, user_id, request):
+        """
+        Start streaming events about a work to a request.  The stream's
+        C{closed} fires when the client goes away.
+        """
+        request.setHeader(b"Content-Type", b"text/event-stream")
+        request.setHeader(b"Cache-Control", b"no-cache")
+        # Stop proxies holding events back.
+        request.setHeader(b"X-Accel-Buffering", b"no")
+        request.write(b"retry: 5000\n\n")
+
+        stream = _Stream(work_id, user_id, request)
+        self._streams.setdefault(work_id, set()).add(stream)
+        request.notifyFinish().addBoth(lambda _: self.unsubscribe(stream))
+        return stream
+
+    def unsubscribe(self, stream):
+        streams = self._streams.get(stream.work_id)
+
+        if streams is not None:
+            streams.discard(stream)
+
+            if not streams:
+                del self._streams[stream.work_id]
+                self._versions.pop(stream.work_id, None)
+
+        if not stream.closed.called:
+            stream.closed.callback(None)
+
+    def _send(self, streams, event, data):
+        payload = "event: {}\ndata: {}\n\n".format(
+            event, json.dumps(data, separators=(',', ':'))).encode('utf8')
+
+        for stream in list(streams):
+            if not stream.closed.called:
+                stream.request.write(payload)
+
+    async def publish(self, work_id, engine=None, stream=None):
+        """
+        Send the current state of a work to its streams, or just C{stream}.
+        """
+        streams = {stream} if stream is not None else self._streams.get(work_id)
+
+        if not streams:
+            return
+
+        version, message = await work_update(
+            work_id, next(iter(streams)).user_id, engine)
+        self._versions[work_id] = version
+
+        if stream is None:
+            streams = self._streams.get(work_id, ())
+
+        self._send(streams, "update", message)
+
+    def changed(self, work_id):
+        """
+        Tell the streams of a work, if it has any, that it has changed.
+        """
+        if work_id not in self._streams:
+            return
+
+        d = ensureDeferred(self.publish(work_id))
+        d.addErrback(lambda f: self._log.failure(
+            "Failed to send an update of work {work}", f, work=work_id))
+
+    async def check(self, engine=None):
+        """
+        Publish the works being watched whose versions have moved on since
+        they were last published.
+        """
+        if not self._streams:
+            return
+
+        if not engine:
+            engine = get_engine()
+
+        f = await engine.execute(
+            work_table.select().with_only_columns(
+                [work_table.c.id, work_table.c.version]).
+            where(work_table.c.id.in_(list(self._streams))))
+
+        for work_id, version in await f.fetchall():
+            seen = self._versions.get(work_id)
+
+            if seen is None:
+                self._versions[work_id] = version
+            elif seen != version:
+                await self.publish(work_id, engine)
+
+    def _tick(self):
+        for streams in self._streams.values():
+            for stream in streams:
+                stream.request.write(b":\n\n")
+
+        d = ensureDeferred(self.check())
+        d.addErrback(lambda f: self._log.failure("Failed to check works", f))
+        return d
+
+    def stats(self):
+        return {
+            "works": len(self._streams),
+            "streams": sum(len(x) for x in self._streams.values()),
+        }
@@ -0,0 +1,272 @@
+import time
+
+from sqlalchemy.exc import IntegrityError
+
+from twisted.internet.defer import ensureDeferred
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+
+from ._cache import LRUCache
+from ._db import get_engine, counts_table, work_table
+from .daily import rebuild_daily, update_daily
+from .work import WordCount, CountSeries, sparkline_cache
+
+
+class _Pending(object):
+    """
+    The counts of one work waiting to be written.
+    """
+    __slots__ = ("tzoffset", "version", "counts")
+
+    def __init__(self, tzoffset, version):
+        self.tzoffset = tzoffset
+        self.version = version
+        self.counts = CountSeries()
+
+
+class CountIngester(object):
+    """
+    Takes new counts for works without loading their history, and writes them
+    to the counts table in batches.
+
+    A count is dropped if it is the same as the work's newest, which is
+    remembered between submissions.  That memory is tagged with the work
+    version it was read at, so a save from anywhere else (which bumps the
+    version) makes it be read again.
+
+    With C{durability="sync"}, C{submit} writes the count before it returns.
+    With C{"buffered"}, counts are kept in memory and written every
+    C{flush_interval} seconds, once C{max_pending} have built up, when they
+    are about to be read, or when the reactor shuts down; a crash loses at
+    most C{flush_interval} seconds of them.
+    """
+    _log = Logger()
+
+    def __init__(self, clock=None, durability="sync", flush_interval=2.0,
+                 max_pending=500, latest_cache_size=4096):
+        if durability not in ("sync", "buffered"):
+            raise ValueError(
+                "durability must be 'sync' or 'buffered', not {!r}".format(
+                    durability))
+
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self._clock = clock
+        self.durability = durability
+        self._flush_interval = flush_interval
+        self.max_pending = max_pending
+
+        self._pending = {}
+        self._size = 0
+        self._observers = []
+        self._latest = LRUCache(maxsize=latest_cache_size, ttl=3600,
+                                clock=clock)
+
+        self.submitted = 0
+        self.collapsed = 0
+        self.flushes = 0
+        self.written = 0
+        self.dropped = 0
+
+        self._flusher = LoopingCall(self._flush)
+        self._flusher.clock = clock
+
+    def start(self):
+        if self.durability == "buffered" and not self._flusher.running:
+            self._flusher.start(self._flush_interval, now=False)
+
+            if hasattr(self._clock, "addSystemEventTrigger"):
+                self._clock.addSystemEventTrigger("before", "shutdown",
+                                                  self._flush)
+
+    def stop(self):
+        if self._flusher.running:
+            self._flusher.stop()
+
+    def add_observer(self, observer):
+        """
+        Call C{observer} with the ID of each work once its counts are written.
+        """
+        self._observers.append(observer)
+
+    async def latest(self, work, engine=None):
+        """
+        Get the newest count of a work, or C{None} if it has none.
+
+        @param work: The L{Work}, loaded without its counts.
+        """
+        pending = self._pending.get(work.id)
+
+        if pending is not None:
+            return pending.counts.latest
+
+        cached = self._latest.get(work.id)
+
+        if cached is not None and cached[0] == work.version:
+            return cached[1]
+
+        latest = (await WordCount.load_latest_for_many(
+            [work.id], engine=engine))[work.id].latest
+        self._latest.set(work.id, (work.version, latest))
+        return latest
+
+    async def submit(self, work, tzoffset, count, engine=None):
+        """
+        Add a count to a work, unless it is the same as the newest one.
+
+        @param tzoffset: The owner's timezone, for the daily rollup.
+        @return: The work's newest count, which is C{count} unless that was
+            dropped.
+        """
+        self.submitted += 1
+        latest = await self.latest(work, engine)
+
+        if latest is not None and latest.count == count.count:
+            self.collapsed += 1
+            return latest
+
+        pending = self._pending.get(work.id)
+
+        if pending is None:
+            pending = self._pending[work.id] = _Pending(tzoffset, work.version)
+
+        pending.version = work.version
+        pending.counts.append(count)
+        self._size += 1
+
+        if self.durability == "sync":
+            await self.flush(engine)
+        elif self._size >= self.max_pending:
+            self._flush()
+
+        return count
+
+    async def settle(self, ids=None, engine=None):
+        """
+        Write out pending counts before they are read: those of the works in
+        C{ids}, or any at all.
+        """
+        if ids is None:
+            pending = bool(self._pending)
+        else:
+            pending = any(x in self._pending for x in ids)
+
+        if pending:
+            await self.flush(engine)
+
+    async def flush(self, engine=None):
+
+        if not self._pending:
+            return
+
+        pending, self._pending = self._pending, {}
+        self._size = 0
+
+        if not engine:
+            engine = get_engine()
+
+        try:
+            await engine.execute(counts_table.insert().values([
+                {"work": work_id, "at": at, "count": count}
+                for work_id, entry in pending.items()
+                for at, count in zip(entry.counts.ats, entry.counts.values)]))
+        except IntegrityError:
+            # Some are already in the table, saved by another process, so
+            # write each work's on their own to get the rest in.
+            pending = await self._write_each(pending, engine)
+        except:
+            if self.durability == "buffered":
+                self._requeue(pending)
+            raise
+
+        if not pending:
+            return
+
+        await engine.execute(work_table.update().
+                             where(work_table.c.id.in_(list(pending))).
+                             values(version=work_table.c.version + 1,
+                                    modified=int(time.time())))
+
+        self.flushes += 1
+
+        for work_id, entry in pending.items():
+            self.written += len(entry.counts)
+            sparkline_cache.invalidate(work_id)
+            # Correct as long as nothing else saved the work in the meantime,
+            # and if something did, the version won't match.
+            self._latest.set(work_id, (entry.version + 1, entry.counts.latest))
+            await self._roll_up(work_id, entry, engine)
+
+            for observer in self._observers:
+                try:
+                    observer(work_id)
+                except Exception:
+                    self._log.failure("Observer of work {work} failed",
+                                      work=work_id)
+
+    async def _roll_up(self, work_id, entry, engine):
+        # The counts are saved by now, so a failure here mustn't fail the
+        # submission or stop the rest of the batch.
+        try:
+            await update_daily(work_id, entry.counts, entry.tzoffset,
+                               engine=engine)
+        except Exception:
+            self._log.failure("Failed to update the daily rollup of work "
+                              "{work}, rebuilding it", work=work_id)
+        else:
+            return
+
+        try:
+            await rebuild_daily(work_id, entry.tzoffset, engine=engine)
+        except Exception:
+            self._log.failure("Failed to rebuild the daily rollup of work "
+                              "{work}", work=work_id)
+
+    async def _write_each(self, pending, engine):
+        written = {}
+
+        for work_id, entry in pending.items():
+            try:
+                await engine.execute(counts_table.insert().values([
+                    {"work": work_id, "at": at, "count": count}
+                    for at, count in zip(entry.counts.ats, entry.counts.values)]))
+            except IntegrityError:
+                self.dropped += len(entry.counts)
+                self._latest.invalidate(work_id)
+                self._log.warn("Dropped {count} counts of work {work} which "
+                               "were already saved",
+                               count=len(entry.counts), work=work_id)
+            else:
+                written[work_id] = entry
+
+        return written
+
+    def _requeue(self, pending):
+        for work_id, entry in pending.items():
+            newer = self._pending.get(work_id)
+
+            if newer is not None:
+                for count in newer.counts:
+                    entry.counts.append(count)
+                entry.version = newer.version
+
+            self._pending[work_id] = entry
+
+        self._size = sum(len(x.counts) for x in self._pending.values())
+
+    def _flush(self):
+        d = ensureDeferred(self.flush())
+        d.addErrback(lambda f: self._log.failure("Failed to write counts", f))
+        return d
+
+    def stats(self):
+        return {
+            "durability": self.durability,
+            "pending": self._size,
+            "submitted": self.submitted,
+            "collapsed": self.collapsed,
+            "flushes": self.flushes,
+            "written": self.written,
+            "dropped": self.dropped,
+        }
@@ -0,0 +1,288 @@
+"""
+Counters, gauges and histograms of what the server is doing, served in the
+Prometheus text format at C{/metrics} to whoever has C{TAPTAP_METRICS_TOKEN}.
+
+Every process keeps its own, so with C{--workers} each scrape sees one of
+them.
+"""
+
+import functools
+import hmac
+import os
+import threading
+import time
+
+from twisted.web.resource import Resource
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    return "{" + ",".join('{}="{}"'.format(k, _escape(v)) for k, v in labels) + "}"
+
+
+def _format_value(value):
+    if value == float("inf"):
+        return "+Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value) if isinstance(value, float) else str(value)
+
+
+class _Metric(object):
+    type = None
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labels)
+        self._lock = threading.Lock()
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(str(labels[x]) for x in self.labelnames)
+
+    def _labels(self, key):
+        return list(zip(self.labelnames, key))
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, self._labels(key), value
+
+
+class Gauge(Counter):
+    type = "gauge"
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for x, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][x] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(key, (list(counts), total, count))
+                      for key, (counts, total, count) in self._values.items()]
+        for key, (counts, total, count) in values:
+            labels = self._labels(key)
+            for bound, bucket in zip(self.buckets, counts):
+                yield self.name + "_bucket", labels + [("le", _format_value(float(bound)))], bucket
+            yield self.name + "_sum", labels, total
+            yield self.name + "_count", labels, count
+
+
+class Registry(object):
+    """
+    Metrics, and collectors which are asked for theirs whenever they are
+    rendered.  A collector returns C{(name, type, help, [(labels, value)])}
+    tuples, where labels is a dict.
+    """
+
+    def __init__(self):
+        self._metrics = []
+        self._collectors = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name, help, labels=()):
+        return self._add(Gauge(name, help, labels))
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self._add(Histogram(name, help, labels, buckets))
+
+    def register_collector(self, collector):
+        self._collectors.append(collector)
+
+    def render(self):
+        lines = []
+
+        for metric in self._metrics:
+            lines.append("# HELP {} {}".format(metric.name, metric.help))
+            lines.append("# TYPE {} {}".format(metric.name, metric.type))
+            for name, labels, value in metric.samples():
+                lines.append("{}{} {}".format(name, _format_labels(labels),
+                                              _format_value(value)))
+
+        for collector in self._collectors:
+            for name, type, help, samples in collector():
+                lines.append("# HELP {} {}".format(name, help))
+                lines.append("# TYPE {} {}".format(name, type))
+                for labels, value in samples:
+                    lines.append("{}{} {}".format(
+                        name, _format_labels(sorted(labels.items())),
+                        _format_value(value)))
+
+        return ("\n".join(lines) + "\n").encode('utf8')
+
+
+def stats_collector(prefix, help, stats, labels=None):
+    """
+    Make a collector that gives each number in the dict from C{stats()} as a
+    gauge named C{prefix_<key>}.
+    """
+    labels = labels or {}
+
+    def collect():
+        for key, value in sorted(stats().items()):
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                yield ("{}_{}".format(prefix, key), "gauge",
+                       "{} ({}).".format(help, key), [(labels, value)])
+
+    return collect
+
+
+registry = Registry()
+
+requests = registry.counter(
+    "taptap_requests_total", "Requests handled, by route and response code.",
+    ["route", "code"])
+request_seconds = registry.histogram(
+    "taptap_request_seconds", "Time taken to answer requests, by route.",
+    ["route"])
+requests_in_flight = registry.gauge(
+    "taptap_requests_in_flight", "Requests being answered, by route.",
+    ["route"])
+request_queries = registry.histogram(
+    "taptap_request_db_queries", "Database round trips per request, by route.",
+    ["route"], buckets=(0, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32))
+request_db_seconds = registry.histogram(
+    "taptap_request_db_seconds",
+    "Time per request spent waiting for the database, by route.", ["route"])
+query_seconds = registry.histogram(
+    "taptap_db_query_seconds",
+    "Time the database took to run each statement, by kind of statement.",
+    ["statement"])
+caller_seconds = registry.histogram(
+    "taptap_db_call_seconds",
+    "Time from sending each statement to getting its result, by the function "
+    "that sent it.", ["caller"])
+
+
+def instrumented(f):
+    """
+    Record the latency, response code and database use of a Klein route.
+    """
+    route = f.__qualname__
+
+    @functools.wraps(f)
+    async def wrapper(self, request, *args, **kwargs):
+        requests_in_flight.inc(route=route)
+        started = time.perf_counter()
+        code = "exception"
+
+        try:
+            result = await f(self, request, *args, **kwargs)
+            code = request.code
+            return result
+        finally:
+            requests_in_flight.dec(route=route)
+            request_seconds.observe(time.perf_counter() - started, route=route)
+            requests.inc(route=route, code=code)
+
+            uow = getattr(request, "_taptap_unit_of_work", None)
+            if uow is not None:
+                request_queries.observe(uow.queries, route=route)
+                request_db_seconds.observe(uow.query_time, route=route)
+
+    return wrapper
+
+
+def instrument_engine(engine):
+    """
+    Time every statement a SQLAlchemy engine runs.  These events fire in the
+    threads the queries run in.
+    """
+    from sqlalchemy import event
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def before(conn, cursor, statement, parameters, context, executemany):
+        context._taptap_started = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def after(conn, cursor, statement, parameters, context, executemany):
+        started = getattr(context, "_taptap_started", None)
+        if started is not None:
+            query_seconds.observe(time.perf_counter() - started,
+                                  statement=(statement.split(None, 1) or ["?"])[0].upper())
+
+
+def observe_trace(trace):
+    """
+    A L{taptap.tracing.Tracer} observer.
+    """
+    caller_seconds.observe(trace.duration, caller=trace.caller)
+
+
+class MetricsResource(Resource):
+    """
+    Serves the metrics to requests bearing C{token}, or to nobody if there
+    isn't one.
+    """
+    isLeaf = True
+
+    def __init__(self, token=None, registry=registry):
+        super().__init__()
+        self._token = token if token is not None else os.environ.get(
+            "TAPTAP_METRICS_TOKEN")
+        self._registry = registry
+
+    def render_GET(self, request):
+        if not self._token:
+            request.setResponseCode(404)
+            return b""
+
+        given = request.getHeader(b"Authorization") or b""
+        expected = b"Bearer " + self._token.encode('utf8')
+
+        if not hmac.compare_digest(given, expected):
+            request.setResponseCode(401)
+            request.setHeader(b"WWW-Authenticate", b'Bearer realm="metrics"')
+            return b""
+
+        request.setHeader(b"Content-Type", b"text/plain; version=0.0.4")
+        request.setHeader(b"Cache-Control", b"no-store")
+        return self._registry.render()
@@ -0,0 +1,221 @@
+"""
+Versioned upgrades of the database schema.
+
+C{python -m taptap.migrations} brings the database up to date,
+C{python -m taptap.migrations status} lists what has been applied, and
+C{python -m taptap.migrations explain} prints the query plans of the queries
+every page load makes.
+"""
+
+import sys
+import time
+
+from sqlalchemy import select, func
+from sqlalchemy.schema import CreateTable
+
+from ._db import (
+    get_engine, schema_table, user_table, cookie_table, oauth_token_table,
+    work_table, counts_table, daily_table
+)
+
+MIGRATIONS = []
+
+
+def migration(version):
+    """
+    Register an upgrade step, called with the engine and a connection.
+
+    Each step runs in a transaction which also records that it was applied.
+    Databases made before there were migrations have some of the schema
+    already, so steps check for what they add before adding it.
+    """
+    def register(f):
+        MIGRATIONS.append((version, f))
+        MIGRATIONS.sort(key=lambda x: x[0])
+        return f
+
+    return register
+
+
+async def _create_table(engine, connection, table):
+    if not await engine.has_table(table.name):
+        await connection.execute(CreateTable(table))
+
+
+async def _has_column(connection, table, column):
+    r = await connection.execute(
+        "SELECT * FROM {} WHERE 1 = 0".format(table.name))
+    return column in await r.keys()
+
+
+async def _create_index(engine, connection, index):
+    quote = engine.dialect.identifier_preparer.quote
+
+    await connection.execute("CREATE INDEX IF NOT EXISTS {} ON {} ({})".format(
+        quote(index.name), quote(index.table.name),
+        ", ".join(quote(x.name) for x in index.columns)))
+
+
+@migration(1)
+async def base_tables(engine, connection):
+    for table in [user_table, cookie_table, work_table, counts_table]:
+        await _create_table(engine, connection, table)
+
+
+@migration(2)
+async def daily_counts(engine, connection):
+    # Filled in lazily by load_daily, or all at once by taptap.daily.
+    await _create_table(engine, connection, daily_table)
+
+
+@migration(3)
+async def work_versions(engine, connection):
+    for column in ["version", "modified"]:
+        if not await _has_column(connection, work_table, column):
+            await connection.execute(
+                "ALTER TABLE works ADD COLUMN {} INTEGER NOT NULL DEFAULT 0".format(
+                    column))
+
+
+@migration(4)
+async def oauth_tokens(engine, connection):
+    await _create_table(engine, connection, oauth_token_table)
+
+
+@migration(5)
+async def hot_path_indexes(engine, connection):
+    # counts needs nothing more: the unique index on (work, at, count) is
+    # already what WordCount.load_for scans, in the order it sorts by.
+    for table in [work_table, cookie_table]:
+        for index in sorted(table.indexes, key=lambda x: x.name):
+            await _create_index(engine, connection, index)
+
+
+async def current_version(engine=None):
+
+    if not engine:
+        engine = get_engine()
+
+    if not await engine.has_table(schema_table.name):
+        return 0
+
+    f = await engine.execute(select([func.max(schema_table.c.version)]))
+    return (await f.scalar()) or 0
+
+
+async def upgrade(engine=None, target=None):
+    """
+    Apply the migrations newer than the database, up to C{target} if given.
+
+    @return: The versions applied.
+    """
+    if not engine:
+        engine = get_engine()
+
+    if not await engine.has_table(schema_table.name):
+        await engine.execute(CreateTable(schema_table))
+
+    current = await current_version(engine)
+    applied = []
+
+    for version, step in MIGRATIONS:
+        if version <= current:
+            continue
+        if target is not None and version > target:
+            break
+
+        connection = await engine.connect()
+        transaction = await connection.begin()
+
+        try:
+            await step(engine, connection)
+            await connection.execute(schema_table.insert().values(
+                version=version, applied=int(time.time())))
+        except:
+            await transaction.rollback()
+            raise
+        else:
+            await transaction.commit()
+        finally:
+            await connection.close()
+
+        applied.append(version)
+
+    return applied
+
+
+def _hot_queries():
+
+    from .work import _counts_query
+
+    return [
+        ("User.load_works",
+         work_table.select().where(work_table.c.user == 1)),
+        ("WordCount.load_for",
+         _counts_query(1)),
+        ("WordCount.load_for (paged)",
+         _counts_query(1, after=(0, 0), limit=500)),
+        ("get_cookie",
+         cookie_table.select().where(cookie_table.c.cookie == "").
+         where(cookie_table.c.expires >= 0)),
+        ("expire_cookies",
+         cookie_table.delete().where(cookie_table.c.expires < 0)),
+    ]
+
+
+async def explain(engine=None):
+    """
+    Get the query plans of the hot queries, as C{(name, [line])} pairs.
+    """
+    if not engine:
+        engine = get_engine()
+
+    dialect = engine.dialect
+
+    if dialect.name == "sqlite":
+        prefix = "EXPLAIN QUERY PLAN "
+    else:
+        prefix = "EXPLAIN "
+
+    plans = []
+
+    for name, query in _hot_queries():
+        sql = str(query.compile(dialect=dialect,
+                                compile_kwargs={"literal_binds": True}))
+        f = await engine.execute(prefix + sql)
+        plans.append((name, [str(row[-1]) for row in await f.fetchall()]))
+
+    return plans
+
+
+if __name__ == "__main__":
+
+    from twisted.internet.task import react
+    from twisted.internet.defer import ensureDeferred
+
+    async def main(reactor, command="upgrade"):
+        engine = get_engine()
+
+        if command == "upgrade":
+            for version in await upgrade(engine):
+                print("Applied migration {}".format(version))
+            print("At version {}".format(await current_version(engine)))
+
+        elif command == "status":
+            current = await current_version(engine)
+            for version, step in MIGRATIONS:
+                print("{} {} {}".format(
+                    version, step.__name__,
+                    "applied" if version <= current else "pending"))
+
+        elif command == "explain":
+            for name, plan in await explain(engine):
+                print(name)
+                for line in plan:
+                    print("    " + line)
+
+        else:
+            raise SystemExit(
+                "usage: python -m taptap.migrations [upgrade|status|explain]")
+
+    react(lambda r: ensureDeferred(main(r, *sys.argv[1:])))
@@ -0,0 +1,106 @@
+import os
+
+from urllib.parse import quote
+
+from treq.client import HTTPClient
+
+from twisted.internet.defer import DeferredSemaphore, TimeoutError
+from twisted.internet.error import ConnectError, DNSLookupError
+from twisted.internet.task import deferLater
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseNeverReceived
+
+from .users import get_request_token, get_access_token, get_user_details
+
+# Failures where the request can't have done anything, or (for the calls
+# that are safe to repeat) might not have.
+_RETRYABLE = (ConnectError, DNSLookupError, TimeoutError, ResponseNeverReceived)
+
+
+class OAuthClient(object):
+    """
+    Logs users in with Twitter, over connections to it that are kept open
+    between logins.
+
+    Every call has C{timeout} seconds to finish, including reading the
+    response, and at most C{concurrency} are made at once, the rest waiting
+    their turn.  Getting a request token and the user's details are retried
+    up to C{retries} times if they fail to connect or time out; getting the
+    access token is not, since the verifier can only be used once.
+
+    C{base_url} can point at a stand-in server for testing.
+    """
+
+    def __init__(self, consumer_key, consumer_secret,
+                 base_url="https://api.twitter.com", reactor=None, timeout=10,
+                 concurrency=16, max_connections=8, keepalive=240, retries=2):
+        if reactor is None:
+            from twisted.internet import reactor
+
+        self.consumer_key = consumer_key
+        self.consumer_secret = consumer_secret
+        self.base_url = base_url.rstrip("/")
+
+        self._reactor = reactor
+        self._timeout = timeout
+        self._retries = retries
+        self._semaphore = DeferredSemaphore(concurrency)
+
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = max_connections
+        self._pool.cachedConnectionTimeout = keepalive
+        self._http = HTTPClient(Agent(reactor, connectTimeout=timeout,
+                                      pool=self._pool))
+
+        reactor.addSystemEventTrigger("before", "shutdown", self.close)
+
+    @classmethod
+    def from_environ(cls, consumer_key, consumer_secret, **kwargs):
+        return cls(
+            consumer_key, consumer_secret,
+            base_url=os.environ.get("TWITTER_API_BASE", "https://api.twitter.com"),
+            timeout=float(os.environ.get("TAPTAP_OAUTH_TIMEOUT", 10)),
+            concurrency=int(os.environ.get("TAPTAP_OAUTH_CONCURRENCY", 16)),
+            max_connections=int(os.environ.get("TAPTAP_OAUTH_MAX_CONNECTIONS", 8)),
+            keepalive=int(os.environ.get("TAPTAP_OAUTH_KEEPALIVE", 240)),
+            **kwargs)
+
+    def close(self):
+        return self._pool.closeCachedConnections()
+
+    async def _call(self, f, retry, *args, **kwargs):
+        attempt = 0
+
+        def call():
+            d = f(*args, _http=self._http, **kwargs)
+            d.addTimeout(self._timeout, self._reactor)
+            return d
+
+        while True:
+            try:
+                return await self._semaphore.run(call)
+            except _RETRYABLE:
+                if not retry or attempt >= self._retries:
+                    raise
+
+            attempt += 1
+            await deferLater(self._reactor, 0.1 * 2 ** attempt, lambda: None)
+
+    def authenticate_url(self, token):
+        return self.base_url + "/oauth/authenticate?oauth_token=" + quote(token, safe='')
+
+    async def request_token(self, callback_url):
+        return await self._call(
+            get_request_token, True, self.consumer_key, self.consumer_secret,
+            callback_url, _url=self.base_url + "/oauth/request_token")
+
+    async def access_token(self, token, token_secret, verifier):
+        return await self._call(
+            get_access_token, False, self.consumer_key, self.consumer_secret,
+            token, token_secret, verifier,
+            _url=self.base_url + "/oauth/access_token")
+
+    async def user_details(self, token, token_secret):
+        return await self._call(
+            get_user_details, True, self.consumer_key, self.consumer_secret,
+            token, token_secret,
+            _url=self.base_url + "/1.1/account/verify_credentials.json")
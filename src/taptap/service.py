@@ -1,26 +1,157 @@
+import os
+import socket
+import sys
+
 from twisted.python import usage
 from twisted.application import service
+from twisted.internet.address import IPv6Address
 from twisted.internet.endpoints import serverFromString
+from twisted.internet.protocol import ProcessProtocol
+from twisted.logger import Logger
 from twisted.python.filepath import FilePath
 
+from taptap.compaction import Compactor
+from taptap.static import precompress
 from taptap.web import CoreResource
 from twisted.web.server import Site
 
+
+class _WorkerProtocol(ProcessProtocol):
+
+    def __init__(self, service, started):
+        self._service = service
+        self.started = started
+        self.pid = None
+
+    def processEnded(self, reason):
+        self._service._workerEnded(self, reason)
+
+
 class TapTapService(service.Service):
+    """
+    Serve TapTap on an endpoint.
+
+    With more than one worker, this process listens and then starts
+    C{workers - 1} more processes which serve on the same socket, and
+    restarts them if they die, waiting longer each time if they keep dying
+    soon after starting.  Workers are started with C{fd} and
+    C{family} set, and serve on that inherited socket instead.
+
+    Background jobs that should only run once, like compaction, are run by
+    this first process.
+    """
+    _log = Logger()
+
+    # Seconds to wait before restarting a worker, doubling up to the maximum
+    # while they keep dying within STABLE_AFTER seconds of starting.
+    MIN_RESPAWN_DELAY = 1.0
+    MAX_RESPAWN_DELAY = 60.0
+    STABLE_AFTER = 60.0
 
-    def __init__(self, endpoint):
+    def __init__(self, endpoint, workers=1, fd=None, family="inet"):
         self._endpoint = endpoint
+        self._workers = workers
+        self._fd = fd
+        self._family = family
+        self._port = None
+        self._processes = {}
+        self._respawns = set()
+        self._respawn_delay = self.MIN_RESPAWN_DELAY
+        self._compactor = None
 
     def startService(self):
+        service.Service.startService(self)
 
         from twisted.internet import reactor
 
-        resource = CoreResource(FilePath(__file__).sibling('app').path)
+        app = FilePath(__file__).sibling('app').path
+
+        resource = CoreResource(app)
         site = Site(resource)
         site.displayTracebacks = False
+
+        if self._fd is not None:
+            family = socket.AF_INET6 if self._family == "inet6" else socket.AF_INET
+            self._port = reactor.adoptStreamPort(self._fd, family, site)
+            return
+
+        precompress(app)
+
+        if os.environ.get("TAPTAP_COMPACT_INTERVAL"):
+            self._compactor = Compactor(
+                float(os.environ["TAPTAP_COMPACT_INTERVAL"]),
+                retention_days=int(os.environ.get(
+                    "TAPTAP_COUNT_RETENTION_DAYS", 30)))
+            self._compactor.start()
+
         endpoint = serverFromString(reactor, self._endpoint)
-        return endpoint.listen(site)
+        d = endpoint.listen(site)
+        d.addCallback(self._listening)
+        return d
+
+    def stopService(self):
+        service.Service.stopService(self)
+
+        if self._compactor is not None:
+            self._compactor.stop()
+
+        for call in list(self._respawns):
+            call.cancel()
+        self._respawns.clear()
+
+        for process in list(self._processes.values()):
+            process.signalProcess("TERM")
 
+    def _listening(self, port):
+        self._port = port
+
+        for x in range(self._workers - 1):
+            self._spawnWorker()
+
+        return port
+
+    def _spawnWorker(self):
+        from twisted.internet import reactor
+
+        fd = self._port.fileno()
+        family = "inet6" if isinstance(self._port.getHost(), IPv6Address) else "inet"
+        protocol = _WorkerProtocol(self, reactor.seconds())
+
+        process = reactor.spawnProcess(
+            protocol, sys.executable,
+            [sys.executable, "-m", "twisted", "taptap",
+             "--fd", str(fd), "--family", family],
+            env=os.environ, childFDs={0: "w", 1: 1, 2: 2, fd: fd})
+        protocol.pid = process.pid
+        self._processes[protocol] = process
+
+    def _workerEnded(self, protocol, reason):
+        from twisted.internet import reactor
+
+        self._processes.pop(protocol, None)
+
+        if not self.running:
+            return
+
+        ran = reactor.seconds() - protocol.started
+
+        if ran >= self.STABLE_AFTER:
+            self._respawn_delay = self.MIN_RESPAWN_DELAY
+
+        delay = self._respawn_delay
+        self._respawn_delay = min(delay * 2, self.MAX_RESPAWN_DELAY)
+
+        self._log.warn("Worker {pid} exited after {ran:.1f}s ({reason}), "
+                       "restarting it in {delay:.0f}s",
+                       pid=protocol.pid, ran=ran,
+                       reason=reason.getErrorMessage(), delay=delay)
+
+        def respawn():
+            self._respawns.discard(call)
+            self._spawnWorker()
+
+        call = reactor.callLater(delay, respawn)
+        self._respawns.add(call)
 
 
 class Options(usage.Options):
@@ -28,9 +159,18 @@ class Options(usage.Options):
     longdesc = "Personal writing stats."
     optParameters = [
         ["endpoint", "e", None, "Endpoint to listen on."],
+        ["workers", "w", 1, "Number of processes to serve with.", int],
+        # Used by the first process to start the rest.
+        ["fd", None, None, "Serve on this inherited listening socket.", int],
+        ["family", None, "inet", "Address family of --fd (inet or inet6)."],
     ]
 
+    def postOptions(self):
+        if self["workers"] < 1:
+            raise usage.UsageError("--workers must be at least 1.")
+
 
 def makeService(config):
-    service = TapTapService(config['endpoint'])
+    service = TapTapService(config['endpoint'], workers=config['workers'],
+                            fd=config['fd'], family=config['family'])
     return service
@@ -0,0 +1,90 @@
+from twisted.internet.defer import ensureDeferred
+from twisted.internet.task import LoopingCall
+from twisted.logger import Logger
+
+from .users import add_cookie, get_cookie, expire_cookies
+
+
+class SessionStore(object):
+    """
+    An in-memory cache of session cookies to user IDs.
+
+    Sessions are cached when they are made, or the first time an unknown
+    cookie is looked up in the cookies table, and are dropped once they
+    expire.  The table stays the source of truth, so every process sharing
+    the database can check every session.
+    """
+    _log = Logger()
+
+    def __init__(self, clock=None, sweep_interval=600):
+        if clock is None:
+            from twisted.internet import reactor as clock
+
+        self._clock = clock
+        self._sessions = {}
+        self._sweep_interval = sweep_interval
+
+        self._sweeper = LoopingCall(self._sweep)
+        self._sweeper.clock = clock
+
+    def start(self):
+        if not self._sweeper.running:
+            self._sweeper.start(self._sweep_interval)
+
+    def stop(self):
+        if self._sweeper.running:
+            self._sweeper.stop()
+
+    def get(self, cookie):
+        """
+        Get the user ID for a cookie we have cached, or C{None}.
+        """
+        session = self._sessions.get(cookie)
+
+        if session is None:
+            return None
+
+        user_id, expires = session
+
+        if expires < self._clock.seconds():
+            del self._sessions[cookie]
+            return None
+
+        return user_id
+
+    async def lookup(self, cookie, engine=None):
+        """
+        Get the user ID for a cookie, checking the database if we don't have
+        it cached, or C{None} if there is no such session.
+        """
+        user_id = self.get(cookie)
+
+        if user_id is not None:
+            return user_id
+
+        session = await get_cookie(cookie, engine)
+
+        if session is None:
+            return None
+
+        self._sessions[cookie] = session
+        return session[0]
+
+    async def add(self, cookie, user_id, time_to_expiry, engine=None):
+        await add_cookie(cookie, user_id, time_to_expiry, engine)
+        self._sessions[cookie] = (user_id,
+                                  self._clock.seconds() + time_to_expiry)
+
+    async def sweep(self, engine=None):
+        now = self._clock.seconds()
+
+        for cookie, (user_id, expires) in list(self._sessions.items()):
+            if expires < now:
+                del self._sessions[cookie]
+
+        await expire_cookies(engine)
+
+    def _sweep(self):
+        d = ensureDeferred(self.sweep())
+        d.addErrback(lambda f: self._log.failure("Failed to expire sessions", f))
+        return d
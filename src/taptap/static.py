@@ -0,0 +1,191 @@
+import gzip
+import os
+import re
+
+from zope.interface import implementer
+
+from twisted.python.filepath import FilePath
+from twisted.web.iweb import _IRequestEncoder, _IRequestEncoderFactory
+from twisted.web.resource import EncodingResourceWrapper
+from twisted.web.static import File
+
+from .assets import FINGERPRINTED
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+_COMPRESSIBLE = {".html", ".js", ".css", ".json", ".svg", ".map", ".txt",
+                 ".ttf", ".eot"}
+
+_max_age = int(os.environ.get("TAPTAP_STATIC_MAX_AGE", 3600))
+
+
+def _compressors():
+    yield ".gz", lambda data: gzip.compress(data, 9)
+
+    if brotli is not None:
+        yield ".br", lambda data: brotli.compress(data, mode=brotli.MODE_TEXT)
+
+
+def precompress(root, min_size=1024):
+    """
+    Write C{.gz} (and, if the C{brotli} module is installed, C{.br}) copies
+    next to every compressible file under C{root}, so that L{StaticFile} can
+    serve them without compressing anything per request.
+
+    Copies are only remade when they are older than the original.
+    """
+    for child in FilePath(root).walk():
+        if not child.isfile() or child.splitext()[1] not in _COMPRESSIBLE:
+            continue
+
+        if child.getsize() < min_size:
+            continue
+
+        for suffix, compress in _compressors():
+            target = child.siblingExtension(suffix)
+
+            if (target.exists() and
+                    target.getModificationTime() >= child.getModificationTime()):
+                continue
+
+            target.setContent(compress(child.getContent()))
+
+
+def _accepted_encodings(request):
+    accepted = set()
+    header = b",".join(request.requestHeaders.getRawHeaders(b"accept-encoding", []))
+
+    for part in header.split(b","):
+        bits = [x.strip() for x in part.split(b";")]
+
+        if not bits[0]:
+            continue
+
+        quality = 1.0
+
+        for bit in bits[1:]:
+            if bit.startswith(b"q="):
+                try:
+                    quality = float(bit[2:])
+                except ValueError:
+                    pass
+
+        if quality > 0:
+            accepted.add(bits[0].lower())
+
+    return accepted
+
+
+class StaticFile(File):
+    """
+    A static file that is served from a precompressed C{.br} or C{.gz}
+    sibling when the client accepts it, with C{Cache-Control} headers.
+    """
+    _encoded = None
+
+    def _cacheControl(self):
+        if self.type == "text/html":
+            return b"no-cache"
+        if FINGERPRINTED.match(self.basename()):
+            return b"public, max-age=31536000, immutable"
+        return "public, max-age={}".format(_max_age).encode('ascii')
+
+    def render_GET(self, request):
+        if self.isfile():
+            accepted = _accepted_encodings(request)
+
+            for encoding, suffix in [(b"br", ".br"), (b"gzip", ".gz")]:
+                sibling = self.siblingExtension(suffix)
+
+                if encoding in accepted and sibling.isfile():
+                    self._encoded = sibling
+                    request.setHeader(b"Content-Encoding", encoding)
+                    break
+
+            request.setHeader(b"Vary", b"Accept-Encoding")
+            request.setHeader(b"Cache-Control", self._cacheControl())
+
+        return super().render_GET(request)
+
+    def openForReading(self):
+        if self._encoded is not None:
+            return self._encoded.open()
+        return super().openForReading()
+
+    def getFileSize(self):
+        if self._encoded is not None:
+            return self._encoded.getsize()
+        return super().getFileSize()
+
+
+@implementer(_IRequestEncoder)
+class _BrotliEncoder(object):
+
+    def __init__(self, request):
+        self._request = request
+        self._compressor = brotli.Compressor(mode=brotli.MODE_TEXT, quality=5)
+
+    def encode(self, data):
+        return self._compressor.process(data)
+
+    def finish(self):
+        remaining = self._compressor.finish()
+        self._request = None
+        return remaining
+
+
+@implementer(_IRequestEncoderFactory)
+class BrotliEncoderFactory(object):
+    """
+    Compress responses with Brotli, for clients that accept it.  Like
+    L{twisted.web.server.GzipEncoderFactory}, for use with
+    L{twisted.web.resource.EncodingResourceWrapper}.
+    """
+    _brotliCheckRegex = re.compile(br'(:?^|[\s,])br(:?$|[\s,])')
+
+    def encoderForRequest(self, request):
+        acceptHeaders = b','.join(
+            request.requestHeaders.getRawHeaders(b'accept-encoding', []))
+
+        if self._brotliCheckRegex.search(acceptHeaders):
+            encoding = request.responseHeaders.getRawHeaders(b'content-encoding')
+            if encoding:
+                encoding = b','.join(encoding + [b'br'])
+            else:
+                encoding = b'br'
+
+            request.responseHeaders.setRawHeaders(b'content-encoding', [encoding])
+            return _BrotliEncoder(request)
+
+
+class VaryingEncodingResourceWrapper(EncodingResourceWrapper):
+    """
+    An L{EncodingResourceWrapper} whose responses say they vary by
+    C{Accept-Encoding}, compressed or not, so that caches keep them apart.
+    """
+
+    def getEncoder(self, request):
+        request.responseHeaders.addRawHeader(b"Vary", b"Accept-Encoding")
+        return super().getEncoder(request)
+
+
+def encoder_factories():
+    """
+    Encoders for dynamic responses, best first.
+    """
+    from twisted.web.server import GzipEncoderFactory
+
+    if brotli is not None:
+        return [BrotliEncoderFactory(), GzipEncoderFactory()]
+    return [GzipEncoderFactory()]
+
+
+if __name__ == "__main__":
+
+    import sys
+
+    precompress(sys.argv[1] if len(sys.argv) > 1 else
+                FilePath(__file__).sibling('app').path)
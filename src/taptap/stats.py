@@ -0,0 +1,179 @@
+"""
+Writing statistics, computed over parallel arrays of timestamps and counts.
+
+Days are counted as whole days since the epoch in the user's local time,
+worked out with integer arithmetic on their tzoffset.
+"""
+
+import datetime
+import math
+
+from array import array
+
+_EPOCH = datetime.date(1970, 1, 1).toordinal()
+
+
+def local_day(at, tzoffset):
+    """
+    The local day a timestamp falls on, as days since the epoch.
+    """
+    return (at + tzoffset) // 86400
+
+
+def day_to_str(day):
+    return datetime.date.fromordinal(_EPOCH + day).strftime("%Y-%m-%d")
+
+
+def bucket_daily(ats, counts, tzoffset):
+    """
+    Bucket counts into local days.
+
+    @return: Arrays of the days, the highest count on each day, and the
+        first and last timestamps on each day, in day order.
+    """
+    days, values = array('q'), array('q')
+    firsts, lasts = array('q'), array('q')
+    positions = {}
+    last_day = None
+    i = -1
+
+    for at, count in zip(ats, counts):
+        day = (at + tzoffset) // 86400
+
+        if day != last_day:
+            last_day = day
+            i = positions.get(day)
+
+            if i is None:
+                i = positions[day] = len(days)
+                days.append(day)
+                values.append(count)
+                firsts.append(at)
+                lasts.append(at)
+                continue
+
+        if count > values[i]:
+            values[i] = count
+        if at < firsts[i]:
+            firsts[i] = at
+        if at > lasts[i]:
+            lasts[i] = at
+
+    if any(days[x] > days[x + 1] for x in range(len(days) - 1)):
+        order = sorted(range(len(days)), key=days.__getitem__)
+        days, values, firsts, lasts = (
+            array('q', (a[x] for x in order))
+            for a in (days, values, firsts, lasts))
+
+    return days, values, firsts, lasts
+
+
+def daily_stats(days, values, first_at, last_at, word_target, completed,
+                tzoffset, now=None):
+    """
+    Work out the daily progress graph and pace statistics of a work.
+
+    @param days: The local days with counts on them, in order.
+    @param values: The highest count on each of those days.
+    @param first_at: The timestamp of the work's first count.
+    @param last_at: The timestamp of the work's last count.
+    @param now: The server's local time, defaulting to now.
+
+    @return: The body of the C{/works/<id>/daily} API response.
+    """
+    if now is None:
+        now = datetime.datetime.now()
+
+    tz = datetime.timedelta(seconds=tzoffset)
+    times = [day_to_str(day) for day in days]
+    values = list(values)
+    diffs = [values[0]] + [values[x] - values[x - 1]
+                           for x in range(1, len(values))]
+
+    best_day = max(diffs)
+    best_days = [times[x] for x in range(len(times)) if diffs[x] == best_day]
+    until_target = word_target - values[-1]
+
+    start = datetime.datetime.utcfromtimestamp(first_at) + tz
+
+    if completed:
+        end = datetime.datetime.utcfromtimestamp(last_at) + tz
+    else:
+        end = now + tz
+
+    elapsed_days = (end - start).days + 1
+
+    words_per_day = values[-1] // elapsed_days if values[-1] else 0
+    words_per_writing_day = values[-1] // len(values) if len(values) else 0
+
+    if completed:
+        writing_days_until_target = "N/A"
+        finished_at_pace = "N/A"
+
+    else:
+        writing_days_until_target = math.ceil(until_target / words_per_writing_day) if until_target != 0 and words_per_writing_day != 0 else "∞"
+        finished_at_pace = ((now - tz) + datetime.timedelta(days=math.ceil(until_target / words_per_day))).strftime("%Y-%m-%d") if until_target != 0 and words_per_day != 0 else "∞"
+
+        today = (now - tz).strftime("%Y-%m-%d")
+
+        if today not in times:
+            times.append(today)
+            values.append(values[-1])
+
+    return {
+        "x": times,
+        "y": values,
+        "stats": {
+            "best_day": "{} ({} words)".format(",".join(best_days), best_day),
+            "until_target": until_target,
+            "words_per_day": words_per_day,
+            "words_per_writing_day": words_per_writing_day,
+            "writing_days_until_target": writing_days_until_target,
+            "finished_at_pace": finished_at_pace
+        }
+    }
+
+
+def downsample(ats, values, points):
+    """
+    Pick at most C{points} of the counts that keep the shape of the series,
+    using Largest-Triangle-Three-Buckets.
+
+    @return: A list of C{(at, count)} tuples, always including the first and
+        last counts.
+    """
+    length = len(ats)
+
+    if length <= points:
+        return list(zip(ats, values))
+
+    if points < 3:
+        return [(ats[0], values[0]), (ats[-1], values[-1])][-points:]
+
+    sampled = [(ats[0], values[0])]
+    every = (length - 2) / (points - 2)
+    a = 0
+
+    for bucket in range(points - 2):
+        # The average point of the next bucket is the third corner.
+        avg_start = int((bucket + 1) * every) + 1
+        avg_end = min(int((bucket + 2) * every) + 1, length)
+        avg_at = sum(ats[avg_start:avg_end]) / (avg_end - avg_start)
+        avg_value = sum(values[avg_start:avg_end]) / (avg_end - avg_start)
+
+        a_at, a_value = ats[a], values[a]
+        max_area = -1
+        chosen = start = int(bucket * every) + 1
+
+        for x in range(start, int((bucket + 1) * every) + 1):
+            area = abs((a_at - avg_at) * (values[x] - a_value) -
+                       (a_at - ats[x]) * (avg_value - a_value))
+            if area > max_area:
+                max_area = area
+                chosen = x
+
+        sampled.append((ats[chosen], values[chosen]))
+        a = chosen
+
+    sampled.append((ats[-1], values[-1]))
+    return sampled
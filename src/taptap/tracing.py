@@ -0,0 +1,207 @@
+"""
+Tracing of the statements run through the engine from L{get_engine}.
+
+Every statement is timed from when it is sent to when its result comes back,
+and tagged with the code that sent it.  Observers added to L{tracer} are
+called with a L{Trace} of each; the last few are kept in C{tracer.recent}.
+
+Statements that take at least C{TAPTAP_SLOW_QUERY_MS} milliseconds are
+logged, and with C{TAPTAP_SLOW_QUERY_EXPLAIN=1}, slow SELECTs are run again
+under C{EXPLAIN ANALYZE} (C{EXPLAIN QUERY PLAN} on SQLite) and the plan
+logged too.
+"""
+
+import collections
+import os
+import sys
+import time
+
+from twisted.logger import Logger
+from twisted.python.failure import Failure
+
+# Frames in these modules are the plumbing between the caller and the engine.
+_PLUMBING = {"taptap._db", "taptap.tracing"}
+
+
+def _caller():
+    frame = sys._getframe(2)
+
+    while frame is not None and frame.f_globals.get("__name__") in _PLUMBING:
+        frame = frame.f_back
+
+    if frame is None:
+        return "?", 0, "?"
+
+    return (frame.f_globals.get("__name__", "?"), frame.f_lineno,
+            frame.f_code.co_name)
+
+
+class Trace(object):
+    """
+    One statement that was run.
+
+    @ivar caller: Where it came from, like C{"taptap.work.load_for"}.
+    @ivar site: The same, with the line number.
+    """
+
+    def __init__(self, statement, multiparams, params, caller, duration,
+                 dialect, failed=False):
+        self.statement = statement
+        self.multiparams = multiparams
+        self.params = params
+        module, line, function = caller
+        self.caller = "{}.{}".format(module, function)
+        self.site = "{}:{}".format(self.caller, line)
+        self.duration = duration
+        self.failed = failed
+        self._dialect = dialect
+        self._compiled = None
+
+    def _compile(self):
+        if self._compiled is None and hasattr(self.statement, "compile"):
+            self._compiled = self.statement.compile(dialect=self._dialect)
+        return self._compiled
+
+    @property
+    def sql(self):
+        compiled = self._compile()
+        return str(self.statement) if compiled is None else str(compiled)
+
+    @property
+    def bound(self):
+        """
+        The parameters to send with L{sql}, in the form the driver wants.
+        """
+        compiled = self._compile()
+
+        if compiled is None:
+            return self.multiparams[0] if self.multiparams else self.params
+
+        if compiled.positional:
+            return tuple(compiled.params[x] for x in compiled.positiontup)
+
+        return compiled.params
+
+    @property
+    def shape(self):
+        """
+        How many parameters it had and of what types, without their values.
+        """
+        compiled = self._compile()
+
+        if compiled is not None:
+            values = list(compiled.params.values())
+        elif self.multiparams and isinstance(self.multiparams[0], dict):
+            values = list(self.multiparams[0].values())
+        elif self.multiparams:
+            values = list(self.multiparams)
+        else:
+            values = list(self.params.values())
+
+        types = collections.Counter(type(x).__name__ for x in values)
+        return "{} params ({})".format(len(values), ", ".join(
+            "{} {}".format(count, name) for name, count in sorted(types.items())))
+
+
+class Tracer(object):
+
+    _log = Logger(namespace="taptap.slow_query")
+
+    def __init__(self, slow_ms=None, explain=False, keep=100):
+        self.slow = None if slow_ms is None else slow_ms / 1000.0
+        self.explain = explain
+        self.recent = collections.deque(maxlen=keep)
+        self._observers = []
+
+    @classmethod
+    def from_environ(cls):
+        slow_ms = os.environ.get("TAPTAP_SLOW_QUERY_MS")
+
+        return cls(
+            slow_ms=float(slow_ms) if slow_ms else None,
+            explain=os.environ.get("TAPTAP_SLOW_QUERY_EXPLAIN", "0") == "1",
+            keep=int(os.environ.get("TAPTAP_TRACE_KEEP", 100)))
+
+    def add_observer(self, observer):
+        self._observers.append(observer)
+
+    def finished(self, result, engine, statement, multiparams, params, caller,
+                 started):
+        trace = Trace(statement, multiparams, params, caller,
+                      time.perf_counter() - started, engine.dialect,
+                      failed=isinstance(result, Failure))
+        self.recent.append(trace)
+
+        for observer in self._observers:
+            observer(trace)
+
+        if self.slow is not None and trace.duration >= self.slow:
+            self._slow_query(engine, trace)
+
+        return result
+
+    def _slow_query(self, engine, trace):
+        self._log.warn(
+            "Slow query ({duration:.1f}ms) from {site}: {sql} -- {shape}",
+            duration=trace.duration * 1000, site=trace.site, sql=trace.sql,
+            shape=trace.shape)
+
+        if not self.explain or not trace.sql.lstrip().upper().startswith("SELECT"):
+            return
+
+        if engine.dialect.name == "sqlite":
+            prefix = "EXPLAIN QUERY PLAN "
+        else:
+            prefix = "EXPLAIN ANALYZE "
+
+        d = engine.execute(prefix + trace.sql, trace.bound)
+        d.addCallback(lambda r: r.fetchall())
+
+        @d.addCallback
+        def _(rows):
+            self._log.warn("Plan of slow query from {site}:\n{plan}",
+                           site=trace.site,
+                           plan="\n".join(str(row[-1]) for row in rows))
+
+        d.addErrback(lambda f: self._log.failure(
+            "Could not explain slow query from {site}", f, site=trace.site))
+
+
+tracer = Tracer.from_environ()
+
+
+class _Traced(object):
+
+    def __init__(self, target, engine, tracer):
+        self._target = target
+        self._traced_engine = engine
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        return getattr(self._target, name)
+
+    def execute(self, statement, *multiparams, **params):
+        caller = _caller()
+        started = time.perf_counter()
+        d = self._target.execute(statement, *multiparams, **params)
+        d.addBoth(self._tracer.finished, self._traced_engine, statement,
+                  multiparams, params, caller, started)
+        return d
+
+
+class TracingConnection(_Traced):
+    pass
+
+
+class TracingEngine(_Traced):
+    """
+    An alchimia engine that traces what is run on it and its connections.
+    """
+
+    def __init__(self, engine, tracer=tracer):
+        super().__init__(engine, engine, tracer)
+
+    def connect(self):
+        d = self._target.connect()
+        d.addCallback(TracingConnection, self._target, self._tracer)
+        return d
@@ -13,10 +13,19 @@ from urllib.parse import urlencode, quote as _quote, unquote, parse_qs
 
 from twisted.internet.defer import ensureDeferred
 
-from ._db import get_engine, user_table, cookie_table, work_table
+from ._cache import LRUCache
+from ._db import (
+    get_engine, user_table, cookie_table, oauth_token_table, work_table
+)
 
 quote = lambda x: _quote(x, safe='')
 
+# Users are loaded by every API call but hardly ever change, so keep them
+# around; User.save drops the cached copy.
+user_cache = LRUCache(
+    maxsize=int(os.environ.get("TAPTAP_USER_CACHE_SIZE", 1024)),
+    ttl=int(os.environ.get("TAPTAP_USER_CACHE_TTL", 300)))
+
 
 @attr.s
 class User(object):
@@ -26,6 +35,11 @@ class User(object):
 
     @classmethod
     async def load(cls, id, engine=None):
+        user = user_cache.get(id)
+
+        if user is not None:
+            return user
+
         if not engine:
             engine = get_engine()
 
@@ -36,11 +50,14 @@ class User(object):
         result = await f.fetchone()
 
         await e.close()
-        return cls(
+        user = cls(
             id=result[user_table.c.id],
             name=result[user_table.c.name],
             tzoffset=result[user_table.c.tzoffset])
 
+        user_cache.set(id, user)
+        return user
+
     async def save(self, engine=None):
         if not engine:
             engine = get_engine()
@@ -59,9 +76,15 @@ class User(object):
                                    tzoffset=self.tzoffset))
 
         await e.close()
+        user_cache.invalidate(self.id)
         return self
 
-    async def load_work(self, id, engine=None):
+    async def load_work(self, id, engine=None, **window):
+        """
+        Load one of this user's works.
+
+        @param window: Which counts to load; see L{Work._load_counts}.
+        """
         from .work import Work
 
         if not engine:
@@ -73,12 +96,13 @@ class User(object):
             work_table.c.user == self.id).where(work_table.c.id == id))
 
         result = await r.fetchone()
-        loaded = await Work._load_from_data(result, engine)
+
+        loaded = await Work._load_from_data(result, e, **window)
 
         await e.close()
         return loaded
 
-    async def load_works(self, engine=None):
+    async def load_works(self, engine=None, **window):
 
         from .work import Work
 
@@ -90,11 +114,7 @@ class User(object):
         r = await e.execute(work_table.select().where(work_table.c.user == self.id))
 
         results = await r.fetchall()
-
-        done_results = []
-
-        for result in results:
-            done_results.append(await Work._load_from_data(result, e))
+        done_results = await Work._load_many_from_data(results, e, **window)
 
         await e.close()
 
@@ -119,7 +139,27 @@ async def add_cookie(cookie, id, time_to_expiry, engine=None):
     return f
 
 
-async def get_cookies(engine=None):
+async def get_cookie(cookie, engine=None):
+
+    if not engine:
+        engine = get_engine()
+
+    e = await engine.connect()
+
+    f = await e.execute(cookie_table.select().
+                        where(cookie_table.c.cookie == cookie.decode('utf8')).
+                        where(cookie_table.c.expires >= time.time()))
+    result = await f.fetchone()
+
+    await e.close()
+
+    if result is None:
+        return None
+
+    return result[cookie_table.c.id], result[cookie_table.c.expires]
+
+
+async def expire_cookies(engine=None):
 
     if not engine:
         engine = get_engine()
@@ -129,16 +169,78 @@ async def get_cookies(engine=None):
     await e.execute(cookie_table.delete().where(
         cookie_table.c.expires < time.time()))
 
-    f = await e.execute(cookie_table.select())
+    await e.close()
+
 
-    cookies = await f.fetchall()
-    cookiedict = {}
+async def add_oauth_token(token, secret, time_to_expiry, engine=None):
 
-    for cookie in cookies:
-        cookiedict[cookie.cookie.encode('utf8')] = cookie.id
+    if not engine:
+        engine = get_engine()
+
+    e = await engine.connect()
+
+    await e.execute(oauth_token_table.insert().values(
+        token=token,
+        secret=secret,
+        expires=time.time() + time_to_expiry
+    ))
+
+    await e.close()
+
+
+async def pop_oauth_token(token, engine=None):
+    """
+    Get the secret of an OAuth request token and forget it, so that it can
+    only be used once.  Returns C{None} if the token is unknown, expired, or
+    was already used.
+    """
+    if not engine:
+        engine = get_engine()
+
+    e = await engine.connect()
+
+    await e.execute(oauth_token_table.delete().where(
+        oauth_token_table.c.expires < time.time()))
+
+    f = await e.execute(oauth_token_table.select().
+                        where(oauth_token_table.c.token == token))
+    result = await f.fetchone()
+    secret = None
+
+    if result is not None:
+        deleted = await e.execute(oauth_token_table.delete().where(
+            oauth_token_table.c.token == token))
+
+        # Only whoever actually deleted it gets to use it.
+        if deleted.rowcount == 1:
+            secret = result[oauth_token_table.c.secret]
 
     await e.close()
-    return cookiedict
+    return secret
+
+
+class OAuthError(Exception):
+    """
+    Twitter answered an OAuth request with something other than a 200.
+    """
+
+    def __init__(self, code, body):
+        super().__init__("HTTP {}: {!r}".format(code, body[:200]))
+        self.code = code
+        self.body = body
+
+
+def _read(response, reader):
+    if response.code != 200:
+        d = treq.content(response)
+
+        @d.addCallback
+        def _(body):
+            raise OAuthError(response.code, body)
+
+        return d
+
+    return reader(response)
 
 
 def get_nonce():
@@ -162,7 +264,8 @@ def make_signature(method, url, content, key):
 
 
 def get_request_token(consumer_key, consumer_secret, callback_url,
-                      _url="https://api.twitter.com/oauth/request_token"):
+                      _url="https://api.twitter.com/oauth/request_token",
+                      _http=treq):
 
     nonce = get_nonce()
     timestamp = get_timestamp()
@@ -187,15 +290,16 @@ def get_request_token(consumer_key, consumer_secret, callback_url,
             'oauth_version="1.0"').format(quote(callback_url), consumer_key,
                                           nonce, signature, timestamp)}
 
-    d = treq.post(_url, headers=headers, body=b'')
-    d.addCallback(treq.text_content, encoding='utf8')
+    d = _http.post(_url, headers=headers, data=b'')
+    d.addCallback(_read, lambda r: treq.text_content(r, encoding='utf8'))
     d.addCallback(parse_qs)
     return d
 
 
 def get_access_token(consumer_key, consumer_secret, token, token_secret,
                      verifier,
-                     _url="https://api.twitter.com/oauth/access_token"):
+                     _url="https://api.twitter.com/oauth/access_token",
+                     _http=treq):
 
     nonce = get_nonce()
     timestamp = get_timestamp()
@@ -221,13 +325,14 @@ def get_access_token(consumer_key, consumer_secret, token, token_secret,
             'oauth_version="1.0"').format(consumer_key, nonce, signature,
                                           timestamp, quote(token))}
 
-    d = treq.post(_url, headers=headers, params={'oauth_verifier': verifier})
-    d.addCallback(treq.text_content, encoding='utf8')
+    d = _http.post(_url, headers=headers, params={'oauth_verifier': verifier})
+    d.addCallback(_read, lambda r: treq.text_content(r, encoding='utf8'))
     d.addCallback(parse_qs)
     return d
 
 def get_user_details(consumer_key, consumer_secret, token, token_secret,
-                     _url="https://api.twitter.com/1.1/account/verify_credentials.json"):
+                     _url="https://api.twitter.com/1.1/account/verify_credentials.json",
+                     _http=treq):
 
     nonce = get_nonce()
     timestamp = get_timestamp()
@@ -252,6 +357,6 @@ def get_user_details(consumer_key, consumer_secret, token, token_secret,
             'oauth_version="1.0"').format(consumer_key, nonce, signature,
                                           timestamp, quote(token))}
 
-    d = treq.get(_url, headers=headers)
-    d.addCallback(treq.json_content)
+    d = _http.get(_url, headers=headers)
+    d.addCallback(_read, treq.json_content)
     return d
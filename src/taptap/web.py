@@ -1,5 +1,6 @@
 import attr
 import cattr
+import hashlib
 import json
 import os
 import time
@@ -10,19 +11,37 @@ from base64 import b64encode
 
 from urllib.parse import urlparse, urlunparse
 
-from typing import List
 from attr.validators import instance_of, optional
 
 from twisted.internet.defer import ensureDeferred
-from twisted.web.resource import Resource
+from twisted.web import http
+from twisted.web.resource import Resource, EncodingResourceWrapper
 from twisted.web.static import File
+from twisted.web.util import DeferredResource
 from twisted.web.server import NOT_DONE_YET
 from twisted.python.filepath import FilePath
 
 from klein import Klein
 
-from .work import load_works, dump_works, WordCount, Work
-from .users import get_request_token, get_access_token, get_user_details, User, add_cookie, get_cookies
+from ._db import unit_of_work
+from ._json import encode
+from ._offload import get_offloader
+from .metrics import (
+    MetricsResource, instrumented, registry, stats_collector
+)
+from .work import (
+    load_sparklines, WordCount, CountSeries, Work, sparkline_cache
+)
+from .users import User, add_oauth_token, pop_oauth_token, user_cache
+from .oauth import OAuthClient
+from .sessions import SessionStore
+from .ingest import CountIngester
+from .events import EventHub
+from .static import (
+    StaticFile, VaryingEncodingResourceWrapper, encoder_factories
+)
+from .daily import load_daily
+from .stats import daily_stats
 
 
 @attr.s
@@ -32,22 +51,31 @@ class APIWork(object):
     completed = attr.ib(validator=instance_of(bool), default=False)
 
     id = attr.ib(validator=optional(instance_of(int)), default=None)
-    counts = attr.ib(validator=optional(instance_of(List[WordCount])), default=None)
+    counts = attr.ib(validator=optional(instance_of(CountSeries)), default=None)
     word_count = attr.ib(validator=optional(instance_of(int)), default=None)
+    sparkline = attr.ib(validator=optional(instance_of(list)), default=None)
 
     @classmethod
-    def from_work(cls, work):
-        word_count = sorted(work.counts, key=lambda x: x.at)[-1].count
+    def from_work(cls, work, latest=None, with_counts=True, sparkline=None):
+        """
+        @param latest: The work's newest count, if C{work.counts} might not
+            include it.
+        @param with_counts: Whether to include C{work.counts}.
+        @param sparkline: The downsampled history of the work, if wanted.
+        """
+        if latest is None:
+            latest = work.counts.latest
 
         return cls(id=work.id,
                    name=work.name,
-                   counts=work.counts,
-                   word_count=word_count,
+                   counts=work.counts if with_counts else None,
+                   word_count=latest.count,
+                   sparkline=sparkline,
                    word_target=work.word_target,
                    completed=work.completed)
 
     def to_new_work(self, user):
-        counts = [WordCount(at=math.floor(time.time()), count=0)]
+        counts = CountSeries([WordCount(at=math.floor(time.time()), count=0)])
 
         return Work(
             name=self.name,
@@ -61,62 +89,319 @@ def _make_cookie_key():
     return b64encode(os.urandom(32))
 
 
-def _make_json(item):
-    return json.dumps(cattr.dumps(item), separators=(',',':')).encode('utf8')
+def _make_json(item, fields=None):
+    return encode(item, fields)
+
+
+def _etag(*parts):
+    # Weak, because the same content is sent compressed or not.
+    return 'W/"{}"'.format(
+        hashlib.sha1(repr(parts).encode('utf8')).hexdigest()).encode('ascii')
+
+
+def _opaque_tag(etag):
+    etag = etag.strip()
+    return etag[2:] if etag.startswith(b"W/") else etag
+
+
+def _not_modified(request, etag, modified=None):
+    """
+    Set the ETag (and Last-Modified, if given) of a response, and work out if
+    the client's copy is still current, in which case the response code is
+    set to 304 and C{True} returned.
+    """
+    request.setHeader(b"ETag", etag)
+    request.setHeader(b"Cache-Control", b"no-cache")
+
+    if modified is not None:
+        request.setHeader(b"Last-Modified", http.datetimeToString(modified))
+
+    if_none_match = request.getHeader(b"if-none-match")
+    if_modified_since = request.getHeader(b"if-modified-since")
+
+    if if_none_match is not None:
+        # If-None-Match compares weakly, ignoring any W/ prefix.
+        tags = [_opaque_tag(x) for x in if_none_match.split(b",")]
+        current = _opaque_tag(etag) in tags or b"*" in tags
+    elif if_modified_since is not None and modified is not None:
+        try:
+            since = http.stringToDatetime(if_modified_since.split(b";")[0])
+        except ValueError:
+            current = False
+        else:
+            current = since >= modified
+    else:
+        current = False
+
+    if current:
+        request.setResponseCode(http.NOT_MODIFIED)
+
+    return current
+
+
+def _daily_json(daily, work, tzoffset, now):
+    result = daily_stats(
+        [x.day for x in daily], [x.value for x in daily],
+        daily[0].first_at, daily[-1].last_at,
+        work.word_target, work.completed, tzoffset, now=now)
+
+    return json.dumps(result, separators=(',',':')).encode('utf8')
+
+
+class BadRequest(Exception):
+    pass
+
+
+def _arg(request, name):
+    value = request.args.get(name.encode('ascii'))
+    return value[0].decode('utf8') if value else None
+
+
+def _count_window(request):
+    """
+    Work out which counts a request wants from its query string:
+    C{counts=all|latest|none}, and for C{all}, C{since=<timestamp>},
+    C{after=<at>:<count>} (the cursor of the previous page) and
+    C{limit=<n>}.
+
+    C{all} is every count that is kept.  Once history is compacted (see
+    L{taptap.compaction}), days older than the retention window only keep
+    their first, highest and last counts.
+    """
+    window = {
+        "counts": _arg(request, "counts") or "all",
+        "since": None,
+        "after": None,
+        "limit": None,
+    }
+
+    if window["counts"] not in ("all", "latest", "none"):
+        raise BadRequest("counts must be all, latest or none")
+
+    try:
+        if _arg(request, "since") is not None:
+            window["since"] = int(_arg(request, "since"))
+
+        if _arg(request, "after") is not None:
+            at, count = _arg(request, "after").split(":")
+            window["after"] = (int(at), int(count))
+
+        if _arg(request, "limit") is not None:
+            window["limit"] = int(_arg(request, "limit"))
+    except ValueError:
+        raise BadRequest("since, after and limit must be integers")
+
+    if window["limit"] is not None and window["limit"] < 1:
+        raise BadRequest("limit must be positive")
+
+    return window
+
+
+def _loading(window):
+    # Even with no counts in the response, we need the newest for word_count.
+    if window["counts"] == "none":
+        return dict(window, counts="latest")
+    return window
+
+
+def _is_windowed(window):
+    return window["counts"] == "all" and any(
+        window[x] is not None for x in ("since", "after", "limit"))
+
+
+def _sparkline_points(request):
+    points = _arg(request, "sparkline")
+
+    if points is None:
+        return None
+
+    try:
+        points = int(points)
+    except ValueError:
+        raise BadRequest("sparkline must be an integer")
+
+    if not 2 <= points <= 500:
+        raise BadRequest("sparkline must be between 2 and 500")
+
+    return points
+
+
+def _fields(request, sparkline=False):
+    fields = _arg(request, "fields")
+
+    if fields is None:
+        # Sparklines are only sent when they're asked for.
+        fields = [x.name for x in attr.fields(APIWork) if x.name != "sparkline"]
+        if sparkline:
+            fields.append("sparkline")
+        return fields
+
+    fields = fields.split(",")
+    unknown = set(fields) - {x.name for x in attr.fields(APIWork)}
+
+    if unknown:
+        raise BadRequest("Unknown fields: " + ",".join(sorted(unknown)))
+
+    return fields
 
 
 class APIResource(object):
 
     app = Klein()
 
-    def __init__(self, cookie_store):
-        self._cookies = cookie_store
+    def __init__(self, ingester, events):
+        self._ingester = ingester
+        self._events = events
+
+    def _user_id(self, request):
+        # Found by CoreResource when it authenticated the request, so that a
+        # session expiring since then doesn't lose it.
+        return request._taptap_user_id
+
+    async def _api_work(self, request, work, window, engine, sparkline=None):
+        latest = None
+
+        if _is_windowed(window):
+            # The newest count might be outside the window.
+            latest = (await WordCount.load_latest_for_many(
+                [work.id], engine=engine))[work.id].latest
+
+            if window["limit"] is not None and len(work.counts) == window["limit"]:
+                last = work.counts[-1]
+                request.responseHeaders.addRawHeader(
+                    "X-Next-Cursor", "{}:{}".format(last.at, last.count))
+
+        if sparkline is not None:
+            sparkline = (await load_sparklines(
+                [work], sparkline, engine=engine))[work.id]
+
+        return APIWork.from_work(work, latest=latest,
+                                 with_counts=window["counts"] != "none",
+                                 sparkline=sparkline)
+
+    @app.handle_errors(BadRequest)
+    def bad_request(self, request, failure):
+        request.setResponseCode(400)
+        request.responseHeaders.setRawHeaders("Content-Type", ["application/json"])
+        return json.dumps({"error": failure.getErrorMessage()}).encode('utf8')
 
     @app.route('/user', methods=['GET'])
+    @instrumented
     async def user_GET(self, request):
         request.responseHeaders.addRawHeader("Content-Type", "application/json")
 
-        user = await User.load(self._cookies[request.getCookie(b"TAPTAP_TOKEN")])
+        db = unit_of_work(request)
+        user = await User.load(self._user_id(request), engine=db)
+
+        if _not_modified(request, _etag(user.id, user.name)):
+            return b''
+
         return json.dumps({"name": user.name}).encode('utf8')
 
 
     @app.route('/works/', methods=["GET"])
+    @instrumented
     async def works_root_GET(self, request):
         request.responseHeaders.addRawHeader("Content-Type", "application/json")
 
-        user = await User.load(self._cookies[request.getCookie(b"TAPTAP_TOKEN")])
-        works = await user.load_works()
+        window = _count_window(request)
+        points = _sparkline_points(request)
+        fields = _fields(request, sparkline=points is not None)
+
+        if window["after"] is not None or window["limit"] is not None:
+            raise BadRequest("after and limit need a single work")
+
+        if points is None and "sparkline" in fields:
+            points = 60
+
+        db = unit_of_work(request)
+        await self._ingester.settle(engine=db)
+        user = await User.load(self._user_id(request), engine=db)
+        works = await user.load_works(engine=db, counts="none")
+
+        etag = _etag(user.id, sorted((x.id, x.version) for x in works),
+                     sorted(request.args.items()))
+        modified = max([x.modified for x in works], default=None)
+
+        if _not_modified(request, etag, modified):
+            return b''
+
+        await Work.load_counts_for(works, engine=db,
+                                   counts=_loading(window)["counts"],
+                                   since=window["since"])
 
-        works = [APIWork.from_work(x) for x in works]
+        latest = {}
+        sparklines = {}
+
+        if _is_windowed(window):
+            latest = await WordCount.load_latest_for_many(
+                [x.id for x in works], engine=db)
+
+        if points is not None:
+            sparklines = await load_sparklines(works, points, engine=db)
+
+        size = sum(len(x.counts) for x in works)
+        works = [APIWork.from_work(x, latest=latest[x.id].latest if latest else None,
+                                   with_counts=window["counts"] != "none",
+                                   sparkline=sparklines.get(x.id))
+                 for x in works]
         works.sort(key=lambda x: x.id)
-        return _make_json(works)
+        return await get_offloader().run(size, _make_json, works, fields)
 
     @app.route('/works/', methods=["POST"])
+    @instrumented
     async def works_root_POST(self, request):
         request.responseHeaders.addRawHeader("Content-Type", "application/json")
 
+        fields = _fields(request)
+
         work_in = cattr.loads(json.loads(request.content.getvalue().decode('utf8')), APIWork)
-        work = work_in.to_new_work(self._cookies[request.getCookie(b"TAPTAP_TOKEN")])
-        await work.save()
+        work = work_in.to_new_work(self._user_id(request))
+        await work.save(engine=unit_of_work(request))
 
-        return _make_json(APIWork.from_work(work))
+        return _make_json(APIWork.from_work(work), fields)
 
 
     @app.route('/works/<int:id>', methods=["GET"])
+    @instrumented
     async def works_item_GET(self, request, id):
         request.responseHeaders.addRawHeader("Content-Type", "application/json")
 
-        user = await User.load(self._cookies[request.getCookie(b"TAPTAP_TOKEN")])
-        work = await user.load_work(id)
-        return _make_json(APIWork.from_work(work))
+        window = _count_window(request)
+        points = _sparkline_points(request)
+        fields = _fields(request, sparkline=points is not None)
+
+        if points is None and "sparkline" in fields:
+            points = 60
+
+        db = unit_of_work(request)
+        await self._ingester.settle([id], engine=db)
+        user = await User.load(self._user_id(request), engine=db)
+        work = await user.load_work(id, engine=db, counts="none")
+
+        etag = _etag(work.id, work.version, sorted(request.args.items()))
+
+        if _not_modified(request, etag, work.modified):
+            return b''
+
+        await Work.load_counts_for([work], engine=db, **_loading(window))
+        api_work = await self._api_work(request, work, window, db, points)
+        return await get_offloader().run(len(work.counts), _make_json,
+                                         api_work, fields)
 
 
     @app.route('/works/<int:id>', methods=["POST"])
+    @instrumented
     async def works_item_POST(self, request, id):
         request.responseHeaders.addRawHeader("Content-Type", "application/json")
 
-        user = await User.load(self._cookies[request.getCookie(b"TAPTAP_TOKEN")])
-        work = await user.load_work(id)
+        window = _count_window(request)
+        fields = _fields(request)
+
+        db = unit_of_work(request)
+        await self._ingester.settle([id], engine=db)
+        user = await User.load(self._user_id(request), engine=db)
+        work = await user.load_work(id, engine=db, **_loading(window))
 
         body = json.loads(request.content.getvalue().decode('utf8'))
         name = body["name"]
@@ -124,119 +409,88 @@ class APIResource(object):
 
         work.name = name
         work.completed = completed
-        await work.save()
+        await work.save(engine=db)
+        self._events.changed(work.id)
 
-        return _make_json(APIWork.from_work(work))
+        return _make_json(await self._api_work(request, work, window, db), fields)
 
 
     @app.route('/works/<int:id>/counts', methods=["POST"])
+    @instrumented
     async def works_counts_POST(self, request, id):
         request.responseHeaders.addRawHeader("Content-Type", "application/json")
 
         body = json.loads(request.content.getvalue().decode('utf8'))
         count = int(body["count"])
         target = int(body["target"])
-        user = await User.load(self._cookies[request.getCookie(b"TAPTAP_TOKEN")])
-        work = await user.load_work(id)
+        window = _count_window(request)
+        fields = _fields(request)
 
-        work.word_target = target
-        if work.counts[-1].count != count:
-            work.counts.append(WordCount(at=math.floor(time.time()), count=count))
-        await work.save()
+        db = unit_of_work(request)
+        user = await User.load(self._user_id(request), engine=db)
+        work = await user.load_work(id, engine=db, counts="none")
 
-        return _make_json(APIWork.from_work(work))
+        if work.word_target != target:
+            work.word_target = target
+            await work.save(engine=db)
+            self._events.changed(work.id)
 
-    @app.route('/works/<int:id>/daily', methods=["GET"])
-    async def works_daily_GET(self, request, id):
-        request.responseHeaders.addRawHeader("Content-Type", "application/json")
-
-        user = await User.load(self._cookies[request.getCookie(b"TAPTAP_TOKEN")])
-        work = await user.load_work(id)
-        counts = {}
-
-        for count in work.counts:
-            dt = (datetime.datetime.utcfromtimestamp(count.at) +
-                  datetime.timedelta(seconds=user.tzoffset))
-            time = dt.strftime("%Y-%m-%d")
-            ct = counts.get(time, [])
-            ct.append(count.count)
-            counts[time] = ct
+        latest = await self._ingester.submit(
+            work, user.tzoffset,
+            WordCount(at=math.floor(time.time()), count=count), engine=db)
 
-        times, values, diffs = [], [], []
-
-        for t, v in counts.items():
-            mx = max(v)
-            if values:
-                diff = mx - values[-1]
-            else:
-                diff = mx
-            diffs.append(diff)
-            values.append(max(v))
-            times.append(t)
-
-        dates = {}
-
-        for x in range(len(times)):
-            dates[times[x]] = {
-                "diff": diffs[x],
-                "value": values[x]}
-
-        best_day = max(diffs)
-        best_days = [x for x, y in dates.items() if y["diff"] == best_day]
-        until_target = work.word_target - values[-1]
-
-        if work.completed:
-            start = (datetime.datetime.utcfromtimestamp(work.counts[0].at) +
-                     datetime.timedelta(seconds=user.tzoffset))
-            end = (datetime.datetime.utcfromtimestamp(work.counts[-1].at) +
-                   datetime.timedelta(seconds=user.tzoffset))
-            days = (end - start).days + 1
+        if window["counts"] == "all":
+            await self._ingester.settle([work.id], engine=db)
+            await Work.load_counts_for([work], engine=db, **window)
         else:
-            start = (datetime.datetime.utcfromtimestamp(work.counts[0].at) +
-                     datetime.timedelta(seconds=user.tzoffset))
-            end = (datetime.datetime.now() +
-                   datetime.timedelta(seconds=user.tzoffset))
-            days = (end - start).days + 1
+            work.counts = CountSeries([latest])
 
-        words_per_day = values[-1] // days if values[-1] else 0
-        words_per_writing_day = values[-1] // len(values) if len(values) else 0
+        return _make_json(await self._api_work(request, work, window, db), fields)
 
-        if work.completed:
-            writing_days_until_target = "N/A"
-            finished_at_pace = "N/A"
+    @app.route('/works/<int:id>/daily', methods=["GET"])
+    @instrumented
+    async def works_daily_GET(self, request, id):
+        request.responseHeaders.addRawHeader("Content-Type", "application/json")
 
-        else:
-            writing_days_until_target = math.ceil(until_target / words_per_writing_day) if until_target != 0 and words_per_writing_day != 0 else "∞"
-            finished_at_pace = ((datetime.datetime.now() - datetime.timedelta(seconds=user.tzoffset)) + datetime.timedelta(days=math.ceil(until_target / words_per_day))).strftime("%Y-%m-%d") if until_target != 0 and words_per_day != 0 else "∞"
-
-        if not work.completed:
-            dat = (datetime.datetime.now() -
-                   datetime.timedelta(seconds=user.tzoffset)).strftime("%Y-%m-%d")
-
-            if dat not in times:
-                times.append(dat)
-                values.append(values[-1])
-                diffs.append(0)
-
-        return json.dumps({
-            "x": times,
-            "y": values,
-            "stats": {
-                "best_day": "{} ({} words)".format(",".join(best_days), best_day),
-                "until_target": until_target,
-                "words_per_day": words_per_day,
-                "words_per_writing_day": words_per_writing_day,
-                "writing_days_until_target": writing_days_until_target,
-                "finished_at_pace": finished_at_pace
-            }
-        }, separators=(',',':')).encode('utf8')
+        db = unit_of_work(request)
+        await self._ingester.settle([id], engine=db)
+        user = await User.load(self._user_id(request), engine=db)
+        work = await user.load_work(id, engine=db, counts="none")
+        daily = await load_daily(work.id, user.tzoffset, engine=db)
+
+        # The response depends on what day it is locally, and (for the pace)
+        # how many days it has been since the first count.
+        now = datetime.datetime.now()
+        tz = datetime.timedelta(seconds=user.tzoffset)
+        elapsed = (now - datetime.datetime.utcfromtimestamp(daily[0].first_at)).days
+        etag = _etag(work.id, work.version, user.tzoffset,
+                     (now - tz).strftime("%Y-%m-%d"), elapsed)
+
+        if _not_modified(request, etag):
+            return b''
+
+        return await get_offloader().run(
+            len(daily), _daily_json, daily, work, user.tzoffset, now)
+
+    @app.route('/works/<int:id>/events', methods=["GET"])
+    async def works_events_GET(self, request, id):
+        db = unit_of_work(request)
+        user = await User.load(self._user_id(request), engine=db)
+        work = await user.load_work(id, engine=db, counts="none")
+
+        # Don't hold a connection for as long as the stream is open.
+        await db.release()
+
+        stream = self._events.subscribe(work.id, user.id, request)
+        await self._events.publish(work.id, stream=stream)
+        await stream.closed
+        return b''
 
 
 class LoginResource(object):
     app = Klein()
-    tokens = {}
 
-    def __init__(self, cookie_store):
+    def __init__(self, sessions):
         if FilePath("secrets.json").exists():
             secrets = json.loads(FilePath("secrets.json").getContent().decode('utf8'))
             self.consumer_key, self.consumer_secret = secrets["key"], secrets["secret"]
@@ -244,9 +498,12 @@ class LoginResource(object):
             self.consumer_key = os.environ["TWITTER_KEY"]
             self.consumer_secret = os.environ["TWITTER_SECRET"]
 
-        self._cookies = cookie_store
+        self._sessions = sessions
+        self._oauth = OAuthClient.from_environ(self.consumer_key,
+                                               self.consumer_secret)
 
     @app.route("/go")
+    @instrumented
     async def go(self, request):
 
         if not os.environ.get("WEB_PATH"):
@@ -268,51 +525,48 @@ class LoginResource(object):
             target_url = web_path + "/login/done"
 
 
-        resp = await get_request_token(self.consumer_key, self.consumer_secret,
-                                       target_url)
+        resp = await self._oauth.request_token(target_url)
 
-        self.tokens[resp["oauth_token"][0]] = resp["oauth_token_secret"][0]
-        to_url = "https://api.twitter.com/oauth/authenticate?oauth_token=" + resp["oauth_token"][0]
+        await add_oauth_token(resp["oauth_token"][0], resp["oauth_token_secret"][0],
+                              3600, engine=unit_of_work(request))
+        to_url = self._oauth.authenticate_url(resp["oauth_token"][0])
         request.redirect(to_url.encode('ascii'))
         return b''
 
     @app.route("/done")
+    @instrumented
     async def done(self, request):
 
         token = request.args[b"oauth_token"][0].decode('utf8')
         verifier = request.args[b"oauth_verifier"][0].decode('utf8')
-        secret = self.tokens.pop(token, None)
+        secret = await pop_oauth_token(token, engine=unit_of_work(request))
 
         if not secret:
             request.redirect("/login/go")
             return
 
-        resp = await get_access_token(self.consumer_key, self.consumer_secret,
-                                      token, secret, verifier)
+        resp = await self._oauth.access_token(token, secret, verifier)
 
         token = resp["oauth_token"][0]
         secret = resp["oauth_token_secret"][0]
 
-        details = await get_user_details(
-            self.consumer_key, self.consumer_secret, token, secret)
+        details = await self._oauth.user_details(token, secret)
 
         u = User(id=details["id"],
                  name=details["name"],
                  tzoffset=details["utc_offset"])
-        await u.save()
+        db = unit_of_work(request)
+        await u.save(engine=db)
 
         if request.getHost().port not in [80, 443]:
             port = ":" + str(request.getHost().port)
 
         key = _make_cookie_key()
 
-        await add_cookie(key, u.id, 604800)
-        cookies = await get_cookies()
-        self._cookies.clear()
-        self._cookies.update(cookies)
+        await self._sessions.add(key, u.id, 604800, engine=db)
 
         request.addCookie("TAPTAP_TOKEN", key, path="/",
-                          max_age=604800, httpOnly=True)
+                          max_age="604800", httpOnly=True)
 
         request.redirect("/")
         return b''
@@ -330,27 +584,90 @@ class CoreResource(File):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
-        self._cookies = {}
-        self._api = APIResource(self._cookies).app.resource()
-        self._login = LoginResource(self._cookies).app.resource()
-
-        d = ensureDeferred(get_cookies())
-
-        @d.addCallback
-        def _(cookies):
-            self._cookies.clear()
-            self._cookies.update(cookies)
+        self._sessions = SessionStore()
+        self._ingester = CountIngester(
+            durability=os.environ.get("TAPTAP_INGEST_DURABILITY", "sync"),
+            flush_interval=float(os.environ.get("TAPTAP_INGEST_INTERVAL", 2)),
+            max_pending=int(os.environ.get("TAPTAP_INGEST_MAX_PENDING", 500)))
+        self._events = EventHub(
+            interval=float(os.environ.get("TAPTAP_EVENTS_INTERVAL", 5)))
+        self._ingester.add_observer(self._events.changed)
+
+        # Event streams skip compression, which would hold events back until
+        # enough had built up to be worth compressing.
+        self._api_events = APIResource(
+            self._ingester, self._events).app.resource()
+        self._api = VaryingEncodingResourceWrapper(self._api_events,
+                                                   encoder_factories())
+        self._login = LoginResource(self._sessions).app.resource()
+        self._metrics = MetricsResource()
+
+        for prefix, help, stats in [
+                ("taptap_user_cache", "User cache", user_cache.stats),
+                ("taptap_sparkline_cache", "Sparkline cache", sparkline_cache.stats),
+                ("taptap_offload", "CPU-heavy work offloading", get_offloader().stats),
+                ("taptap_ingest", "Word count ingestion", self._ingester.stats),
+                ("taptap_events", "Event streams", self._events.stats)]:
+            registry.register_collector(stats_collector(prefix, help, stats))
+
+        self._sessions.start()
+        self._ingester.start()
+        self._events.start()
+
+    def createSimilarFile(self, path):
+        # Children are plain files, not more copies of the whole site.
+        f = StaticFile(path, self.defaultType, self.ignoredExts, self.registry)
+        f.processors = self.processors
+        f.indexNames = self.indexNames[:]
+        f.childNotFound = self.childNotFound
+        return f
 
     def getChild(self, path, request):
 
+        if request.path == b"/metrics":
+            # Has its own access control.
+            return self._metrics
+
         # ~auth check~
-        if request.path[:7] != b"/login/" and request.path[:5] != b"/css/" and request.path[:4] != b"/js/":
+        if (request.path[:7] != b"/login/" and request.path[:5] != b"/css/" and
+                request.path[:4] != b"/js/" and request.path[:6] != b"/dist/"):
             cookie = request.getCookie(b"TAPTAP_TOKEN")
 
-            if not cookie or cookie not in self._cookies:
+            if not cookie:
                 return LoginRedirectResource()
 
+            user_id = self._sessions.get(cookie)
+
+            if user_id is None:
+                # Not one we know about, so check the database for it, and
+                # then carry on finding the child.
+                d = ensureDeferred(self._sessions.lookup(cookie))
+
+                @d.addCallback
+                def _(user_id):
+                    if user_id is None:
+                        return LoginRedirectResource()
+                    request._taptap_user_id = user_id
+                    child = self._getAuthorisedChild(path, request)
+
+                    if isinstance(child, EncodingResourceWrapper):
+                        # Request.process only asks the resource it found,
+                        # the DeferredResource, for an encoder.
+                        request._encoder = child.getEncoder(request)
+
+                    return child
+
+                return DeferredResource(d)
+
+            request._taptap_user_id = user_id
+
+        return self._getAuthorisedChild(path, request)
+
+    def _getAuthorisedChild(self, path, request):
+
         if request.path[:5] == b"/api/":
+            if request.path.endswith(b"/events"):
+                return self._api_events
             return self._api
 
         if request.path[:7] == b"/login/":
@@ -359,4 +676,10 @@ class CoreResource(File):
         if request.path[:6] == b"/sass/":
             return None
 
+        if not path:
+            # Use the index that points at the built bundles, if there is one.
+            built = self.child("dist").child("index.html")
+            if built.exists():
+                return self.createSimilarFile(built.path)
+
         return super(CoreResource, self).getChild(path, request)
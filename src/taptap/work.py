@@ -1,81 +1,338 @@
 import attr
 import cattr
-import json
+import os
+import time
 
-from typing import List
+from array import array
 from attr.validators import instance_of, optional
 
 
-from twisted.python.filepath import FilePath
 from twisted.internet.defer import ensureDeferred
 
+from sqlalchemy import select, func, and_, or_
+
+from ._cache import LRUCache
 from ._db import get_engine, counts_table, work_table
+from ._json import register_encoder
+from .daily import update_daily
+from .stats import downsample
+from .users import User
+
+# Downsampled histories for the work list, keyed by work ID.  Work.save_counts
+# drops a work's entry, and entries are only used while they were made at the
+# work's current version, which anything changing its counts (including
+# compaction in another process) bumps.
+sparkline_cache = LRUCache(
+    maxsize=int(os.environ.get("TAPTAP_SPARKLINE_CACHE_SIZE", 4096)),
+    ttl=int(os.environ.get("TAPTAP_SPARKLINE_CACHE_TTL", 86400)))
+
+
+def _counts_query(for_id, since=None, after=None, limit=None):
+    """
+    The query L{WordCount.load_for} runs.
+    """
+    query = counts_table.select().where(counts_table.c.work == for_id)
+
+    if since is not None:
+        query = query.where(counts_table.c.at > since)
+
+    if after is not None:
+        at, count = after
+        query = query.where(or_(
+            counts_table.c.at > at,
+            and_(counts_table.c.at == at, counts_table.c.count > count)))
+
+    query = query.order_by(counts_table.c.at, counts_table.c.count)
+
+    if limit is not None:
+        query = query.limit(limit)
+
+    return query
+
 
 @attr.s
 class WordCount(object):
     at = attr.ib(validator=instance_of(int))
     count = attr.ib(validator=instance_of(int))
 
-    async def save_for(self, id, engine=None):
-
+    @classmethod
+    async def load_for(cls, for_id, engine=None, since=None, after=None,
+                       limit=None):
+        """
+        Load the counts of a work, oldest first.
+
+        @param since: Only load counts made after this timestamp.
+        @param after: Only load counts after this C{(at, count)} cursor.
+        @param limit: Load at most this many counts.
+        """
         if not engine:
             engine = get_engine()
 
-        values = {
-            "at": self.at,
-            "count": self.count,
-            "work": id
-        }
+        f = await engine.execute(_counts_query(for_id, since, after, limit))
+        result = await f.fetchall()
+        results = CountSeries()
 
-        try:
-            engine.execute(counts_table.insert().values(**values))
-        except:
-            pass
+        for count in result:
+            results.ats.append(count[counts_table.c.at])
+            results.values.append(count[counts_table.c.count])
 
-        return self
+        results._latest = len(results) - 1
+        return results
 
     @classmethod
-    async def load_for(cls, for_id, engine=None):
+    async def load_for_many(cls, for_ids, engine=None, since=None):
 
         if not engine:
             engine = get_engine()
 
-        f = await engine.execute(counts_table.select().
-                                 where(counts_table.c.work == for_id))
+        results = {for_id: CountSeries() for for_id in for_ids}
+
+        if not results:
+            return results
+
+        query = counts_table.select().where(
+            counts_table.c.work.in_(list(results)))
+
+        if since is not None:
+            query = query.where(counts_table.c.at > since)
+
+        f = await engine.execute(query.order_by(
+            counts_table.c.work, counts_table.c.at, counts_table.c.count))
         result = await f.fetchall()
-        results = []
 
         for count in result:
-            results.append(cls(
+            series = results[count[counts_table.c.work]]
+            series.ats.append(count[counts_table.c.at])
+            series.values.append(count[counts_table.c.count])
+
+        for series in results.values():
+            series._latest = len(series) - 1
+
+        return results
+
+    @classmethod
+    async def load_latest_for_many(cls, for_ids, engine=None):
+        """
+        Load only the newest count of each work.
+        """
+        if not engine:
+            engine = get_engine()
+
+        results = {for_id: CountSeries() for for_id in for_ids}
+
+        if not results:
+            return results
+
+        newest = select([counts_table.c.work,
+                         func.max(counts_table.c.at).label("at")]).where(
+            counts_table.c.work.in_(list(results))).group_by(
+            counts_table.c.work).alias()
+
+        f = await engine.execute(
+            select([counts_table]).select_from(counts_table.join(newest, and_(
+                counts_table.c.work == newest.c.work,
+                counts_table.c.at == newest.c.at))).
+            order_by(counts_table.c.count))
+        result = await f.fetchall()
+
+        for count in result:
+            results[count[counts_table.c.work]] = CountSeries([cls(
                 at=count[counts_table.c.at],
-                count=count[counts_table.c.count]))
+                count=count[counts_table.c.count])])
 
         return results
 
 
+class CountSeries(object):
+    """
+    The count history of a work, held as parallel arrays of timestamps and
+    counts rather than as a list of L{WordCount}s.
+
+    It iterates, indexes and appends L{WordCount}s like the list it replaces,
+    and keeps track of which count is the latest.
+    """
+    __slots__ = ("ats", "values", "_latest")
+
+    def __init__(self, counts=()):
+        self.ats = array('q')
+        self.values = array('q')
+        self._latest = -1
+
+        for count in counts:
+            self.append(count)
+
+    @classmethod
+    def from_arrays(cls, ats, values):
+        series = cls()
+        series.ats = array('q', ats)
+        series.values = array('q', values)
+
+        for x in range(len(series.ats)):
+            if series._latest == -1 or series.ats[x] >= series.ats[series._latest]:
+                series._latest = x
+
+        return series
+
+    def __len__(self):
+        return len(self.ats)
+
+    def __iter__(self):
+        for at, count in zip(self.ats, self.values):
+            yield WordCount(at=at, count=count)
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            return CountSeries.from_arrays(self.ats[index], self.values[index])
+
+        return WordCount(at=self.ats[index], count=self.values[index])
+
+    def __eq__(self, other):
+        if not isinstance(other, CountSeries):
+            return NotImplemented
+        return self.ats == other.ats and self.values == other.values
+
+    def __repr__(self):
+        return "CountSeries({!r})".format(list(self))
+
+    @property
+    def latest(self):
+        """
+        The count with the newest timestamp, or C{None} if there are none.
+        """
+        if self._latest == -1:
+            return None
+        return self[self._latest]
+
+    def append(self, count):
+        self.ats.append(count.at)
+        self.values.append(count.count)
+
+        if self._latest == -1 or count.at >= self.ats[self._latest]:
+            self._latest = len(self.ats) - 1
+
+    def sort(self):
+        order = sorted(range(len(self.ats)), key=self.ats.__getitem__)
+        self.ats = array('q', (self.ats[x] for x in order))
+        self.values = array('q', (self.values[x] for x in order))
+        self._latest = len(self.ats) - 1
+
+
+cattr.register_unstructure_hook(
+    CountSeries,
+    lambda series: [{"at": at, "count": count}
+                    for at, count in zip(series.ats, series.values)])
+cattr.register_structure_hook(
+    CountSeries,
+    lambda obj, cl: CountSeries(WordCount(at=x["at"], count=x["count"])
+                                for x in obj))
+
+
+def _encode_series(series, write, chunk=4096):
+    write(b'[')
+    ats, values = series.ats, series.values
+
+    for start in range(0, len(ats), chunk):
+        if start:
+            write(b',')
+        write(b','.join([b'{"at":%d,"count":%d}' % x for x in
+                         zip(ats[start:start + chunk],
+                             values[start:start + chunk])]))
+
+    write(b']')
+
+
+register_encoder(CountSeries, _encode_series)
+
+
 @attr.s
 class Work(object):
     user = attr.ib(validator=instance_of(int))
     name = attr.ib(validator=instance_of(str))
-    counts = attr.ib(validator=instance_of(List[WordCount]))
+    counts = attr.ib(validator=instance_of(CountSeries))
     word_target = attr.ib(validator=instance_of(int))
     completed = attr.ib(validator=instance_of(bool), default=False)
     id = attr.ib(validator=optional(instance_of(int)), default=None)
+    version = attr.ib(validator=instance_of(int), default=0)
+    modified = attr.ib(validator=instance_of(int), default=0)
 
-    @classmethod
-    async def _load_from_data(cls, data, engine):
-
-        counts = await WordCount.load_for(data[work_table.c.id],
-                                          engine=engine)
+    def __attrs_post_init__(self):
+        # Counts are append-only, so everything past this index has not yet
+        # been written to the counts table.
+        self._saved_counts = 0
 
-        return cls(
+    @classmethod
+    def _from_data(cls, data, counts):
+        work = cls(
             id=data[work_table.c.id],
             name=data[work_table.c.name],
             user=data[work_table.c.user],
             word_target=data[work_table.c.word_target],
             completed=data[work_table.c.completed],
+            version=data[work_table.c.version],
+            modified=data[work_table.c.modified],
             counts=counts,
         )
+        work._saved_counts = len(counts)
+        return work
+
+    @property
+    def unsaved_counts(self):
+        return self.counts[self._saved_counts:]
+
+    @classmethod
+    async def _load_counts(cls, ids, engine, counts="all", since=None,
+                           after=None, limit=None):
+        """
+        Load the counts of some works, as a dict of work ID to
+        L{CountSeries}.
+
+        @param counts: C{"all"} of the counts (optionally windowed by
+            C{since}, C{after} and C{limit}, the latter two only for a single
+            work), only the C{"latest"}, or C{"none"}.
+        """
+        if counts == "none":
+            return {x: CountSeries() for x in ids}
+
+        if counts == "latest":
+            return await WordCount.load_latest_for_many(ids, engine=engine)
+
+        if len(ids) == 1:
+            return {ids[0]: await WordCount.load_for(
+                ids[0], engine=engine, since=since, after=after, limit=limit)}
+
+        return await WordCount.load_for_many(ids, engine=engine, since=since)
+
+    @classmethod
+    async def load_counts_for(cls, works, engine=None, **window):
+        """
+        Load the counts of works that were loaded without them.
+        """
+        counts = await cls._load_counts([x.id for x in works], engine, **window)
+
+        for work in works:
+            work.counts = counts[work.id]
+            work._saved_counts = len(work.counts)
+
+        return works
+
+    @classmethod
+    async def _load_from_data(cls, data, engine, **window):
+
+        counts = await cls._load_counts([data[work_table.c.id]], engine,
+                                        **window)
+
+        return cls._from_data(data, counts[data[work_table.c.id]])
+
+    @classmethod
+    async def _load_many_from_data(cls, data, engine, **window):
+        """
+        Build many works at once, fetching all of their counts in one query
+        rather than one query per work.
+        """
+        counts = await cls._load_counts(
+            [x[work_table.c.id] for x in data], engine, **window)
+
+        return [cls._from_data(x, counts[x[work_table.c.id]]) for x in data]
 
     @classmethod
     async def load(cls, id, engine=None):
@@ -86,7 +343,7 @@ class Work(object):
         f = await engine.execute(work_table.select().
                                  where(work_table.c.id == id))
         result = await f.fetchone()
-        return await self._load_from_data(result, engine)
+        return await cls._load_from_data(result, engine)
 
 
     async def save(self, engine=None):
@@ -94,54 +351,81 @@ class Work(object):
         if not engine:
             engine = get_engine()
 
+        self.modified = int(time.time())
+        self.version += 1
+
         values = {
             "name": self.name,
             "word_target": self.word_target,
             "completed": self.completed,
             "user": self.user,
+            "modified": self.modified,
         }
 
         if self.id:
             values["id"] = self.id
+            # Bumped in SQL, so that concurrent saves still each get a new
+            # version in the table.
             await engine.execute(work_table.update().
                                  where(work_table.c.id == self.id).
-                                 values(**values))
+                                 values(version=work_table.c.version + 1,
+                                        **values))
 
         else:
-            res = await engine.execute(work_table.insert().values(**values))
+            res = await engine.execute(work_table.insert().values(
+                version=self.version, **values))
             self.id = res.inserted_primary_key[0]
 
-        for count in self.counts:
-            await count.save_for(self.id)
-
+        await self.save_counts(engine)
         return self
 
+    async def save_counts(self, engine=None):
 
+        new_counts = self.unsaved_counts
 
-def dump_works(works):
-    return json.dumps(cattr.dumps(works), separators=(',',':')).encode('utf8')
+        if not new_counts:
+            return self
 
+        if not engine:
+            engine = get_engine()
 
-def save_works(works):
-    dest = FilePath("works.json")
-    dest.setContent(dump_works(list(works)))
+        await engine.execute(counts_table.insert().values([
+            {"work": self.id, "at": count.at, "count": count.count}
+            for count in new_counts]))
+        self._saved_counts = len(self.counts)
+        sparkline_cache.invalidate(self.id)
+
+        user = await User.load(self.user, engine=engine)
+        await update_daily(self.id, new_counts, user.tzoffset, engine=engine)
+
+        return self
 
 
-def load_works():
 
-    dest = FilePath("works.json")
+async def load_sparklines(works, points, engine=None):
+    """
+    Get the count histories of some works, downsampled to at most C{points}
+    counts each, as a dict of work ID to a list of C{(at, count)}.
 
-    if not dest.exists():
-        dest.setContent(b"[]")
+    The works don't need their counts loaded.
+    """
+    results = {}
+    missing = {}
 
-    loaded = cattr.loads(
-        json.loads(dest.getContent().decode('utf8')),
-        List[Work])
+    for work in works:
+        cached = sparkline_cache.get(work.id)
+
+        if cached is not None and cached[:2] == (work.version, points):
+            results[work.id] = cached[2]
+        else:
+            missing[work.id] = work.version
 
-    x = {}
+    if missing:
+        counts = await WordCount.load_for_many(list(missing), engine=engine)
 
-    for y in loaded:
-        y.counts.sort(key=lambda x: x.at)
-        x[y.id] = y
+        for work_id, series in counts.items():
+            line = [list(x) for x in downsample(series.ats, series.values, points)]
+            results[work_id] = line
+            sparkline_cache.set(work_id, (missing[work_id], points, line))
 
-    return x
+    return results